@@ -10,6 +10,7 @@ from troposphere import (AWS_REGION,
                          AWS_STACK_NAME,
                          Base64,
                          codedeploy,
+                         GetAtt,
                          Join,
                          Parameter,
                          Ref,
@@ -18,6 +19,7 @@ import troposphere.autoscaling as autoscaling
 from troposphere.constants import (IMAGE_ID,
                                    SECURITY_GROUP_ID,
                                    SUBNET_ID,)
+import troposphere.dynamodb as dynamodb
 import troposphere.iam as iam
 import troposphere.policies as policies
 import troposphere.s3 as s3
@@ -52,6 +54,16 @@ imageId = t.add_parameter(Parameter(
     # Default="ami-b9ff39d9",
     Default="ami-65579105",  # Ubuntu 14 LTS
 ))
+instanceCount = t.add_parameter(Parameter(
+    "InstanceCount",
+    Description="How many instances share the jobs",
+    Type="Number",
+    ConstraintDescription="More than one instance needs LEASEBACKEND set in "
+                          "conf.env (e.g. dynamodb://strongjobs-leases) so "
+                          "that jobs are split between them",
+    Default="1",
+    MinValue="1",
+))
 subnetId = t.add_parameter(Parameter(
     "SubnetId",
     Description="The subnet in which to run",
@@ -66,6 +78,23 @@ s3bucket = t.add_resource(s3.Bucket(
     AccessControl=s3.Private,
 ))
 
+# Lease table for splitting the jobs between instances
+# (LEASEBACKEND=dynamodb://strongjobs-leases)
+leaseTable = t.add_resource(dynamodb.Table(
+    "StrongjobsLeaseTable",
+    TableName="strongjobs-leases",
+    AttributeDefinitions=[
+        dynamodb.AttributeDefinition(AttributeName="key", AttributeType="S"),
+    ],
+    KeySchema=[
+        dynamodb.KeySchema(AttributeName="key", KeyType="HASH"),
+    ],
+    ProvisionedThroughput=dynamodb.ProvisionedThroughput(
+        ReadCapacityUnits=5,
+        WriteCapacityUnits=5,
+    ),
+))
+
 # Access management things
 serviceRole = t.add_resource(iam.Role(
     "StrongjobsServiceRole",
@@ -86,7 +115,20 @@ serviceRole = t.add_resource(iam.Role(
     ),
     ManagedPolicyArns=["arn:aws:iam::aws:policy/AmazonS3FullAccess",
                        "arn:aws:iam::aws:policy/service-role/"
-                       "AWSCodeDeployRole"]
+                       "AWSCodeDeployRole"],
+    Policies=[iam.Policy(
+        PolicyName="StrongjobsLeases",
+        PolicyDocument=aws.Policy(
+            Statement=[
+                aws.Statement(
+                    Effect=aws.Allow,
+                    Action=[aws.Action("dynamodb", "GetItem"),
+                            aws.Action("dynamodb", "PutItem")],
+                    Resource=[GetAtt(leaseTable, "Arn")],
+                ),
+            ],
+        ),
+    )],
 ))
 IAMInstanceProfile = t.add_resource(iam.InstanceProfile(
     "StrongjobsInstanceProfile",
@@ -133,9 +175,9 @@ autoScalingGroupStrongjobs = t.add_resource(autoscaling.AutoScalingGroup(
     ),
     LaunchConfigurationName=Ref(launchConfiguration),
     VPCZoneIdentifier=[Ref(subnetId)],
-    MinSize="1",
-    DesiredCapacity="1",
-    MaxSize="1",
+    MinSize=Ref(instanceCount),
+    DesiredCapacity=Ref(instanceCount),
+    MaxSize=Ref(instanceCount),
     Tags=[
         autoscaling.Tag("environment", Ref(AWS_STACK_NAME), "true"),
         autoscaling.Tag("Name",
@@ -0,0 +1,110 @@
+"""
+Time budgets for jobs and their targets.
+
+A Deadline is handed down to anything that can block (HTTP requests, polling
+loops, sockets and subprocesses), which use it to bound how long they wait and
+raise DeadlineExceeded once it has passed. A target's deadline is a child of
+its job's, so it never outlives the job.
+
+The budgets come from the schedule in the crontab:
+
+* JOBDEADLINE -- seconds the whole job may take.
+* TARGETDEADLINE -- seconds a single target may take.
+
+Unset means unlimited.
+"""
+
+from os import environ as env
+from subprocess import PIPE, Popen
+import threading
+import time
+
+
+# Exit code of a job that ran out of time, the same as timeout(1) uses.
+TIMEOUT_EXIT = 124
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def seconds_from_env(name):
+    """Read a number of seconds from the environment, or None if unset."""
+    value = env.get(name)
+    return float(value) if value else None
+
+
+class Deadline(object):
+    """A point in time that work has to be finished by."""
+
+    def __init__(self, seconds=None, parent=None):
+        self.expires = None if seconds is None else time.time() + seconds
+        if parent is not None and parent.expires is not None:
+            self.expires = parent.expires if self.expires is None else min(self.expires, parent.expires)
+
+    @classmethod
+    def from_env(cls, name, parent=None):
+        return cls(seconds_from_env(name), parent)
+
+    def child(self, seconds):
+        """A deadline that ends after seconds, or with this one if sooner."""
+        return Deadline(seconds, self)
+
+    def remaining(self):
+        """Seconds left, or None if unlimited."""
+        if self.expires is None:
+            return None
+        return max(self.expires - time.time(), 0)
+
+    def expired(self):
+        return self.expires is not None and time.time() >= self.expires
+
+    def check(self):
+        """Raise DeadlineExceeded if the deadline has passed."""
+        if self.expired():
+            raise DeadlineExceeded("Ran out of time")
+
+    def timeout(self, cap=None):
+        """Seconds to allow a blocking call, at most cap. None is unlimited."""
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return cap
+        if cap is None:
+            return remaining
+        return min(remaining, cap)
+
+    def sleep(self, seconds):
+        """Sleep, raising DeadlineExceeded if the deadline passes first."""
+        remaining = self.remaining()
+        if remaining is not None and remaining < seconds:
+            time.sleep(remaining)
+            self.check()
+        time.sleep(seconds)
+
+
+# Default for functions that take an optional deadline.
+NO_DEADLINE = Deadline()
+
+
+def run_command(args, cwd=None, deadline=NO_DEADLINE):
+    """
+    Run a command to completion, killing it if the deadline passes first.
+
+    Returns (returncode, stdout, stderr).
+    """
+    timeout = deadline.timeout()
+    proc = Popen(args, cwd=cwd, stdout=PIPE, stderr=PIPE, universal_newlines=True)
+    # Read the output in another thread so that we can stop waiting (and
+    # kill the command) when the deadline passes.
+    output = []
+    reader = threading.Thread(target=lambda: output.extend(proc.communicate()))
+    reader.daemon = True
+    reader.start()
+    reader.join(timeout)
+    if reader.is_alive():
+        proc.kill()
+        reader.join()
+        raise DeadlineExceeded("Killed %s after running out of time" % ' '.join(args[:3]))
+    stdout, stderr = output
+    return proc.returncode, stdout, stderr
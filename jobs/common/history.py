@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""
+Remember job runs between invocations.
+
+Every target a job processes is recorded in a small SQLite database with the
+job name, target, start and end times, exit code, status and a few key results
+(as JSON). Jobs use it to skip targets that were checked recently enough,
+which also makes it safe to run them more often than their schedule to catch
+up on runs missed while the instance was down.
+
+From a shell, answer "when did X last succeed":
+
+    history.py ssllabs "google.com;A+"
+    history.py ssllabs
+"""
+
+from __future__ import absolute_import
+
+import argparse
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import os
+from os import environ as env, path
+import sqlite3
+import time
+
+from deadlines import DeadlineExceeded, TIMEOUT_EXIT
+
+
+DEFAULT_PATH = path.join('~', 'strongjobs-data', 'history.sqlite')
+# Runs older than this (in seconds) are forgotten.
+KEEP_FOR = 90 * 24 * 60 * 60
+
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+TIMED_OUT = "timeout"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    job TEXT NOT NULL,
+    target TEXT NOT NULL,
+    started REAL NOT NULL,
+    ended REAL,
+    exit_code INTEGER,
+    status TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_last ON runs (job, target, status, started);
+"""
+
+
+class RunHistory(object):
+    """The run history database. Set RUNHISTORY to override its location."""
+
+    def __init__(self, db_path=None):
+        self.path = path.expanduser(db_path or env.get('RUNHISTORY', DEFAULT_PATH))
+        directory = path.dirname(self.path)
+        if not path.exists(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        self.prune(KEEP_FOR)
+
+    def start(self, job, target):
+        """Record that a run started and return its id."""
+        with self.db:
+            cursor = self.db.execute("INSERT INTO runs (job, target, started) VALUES (?, ?, ?)",
+                                     (job, target, time.time()))
+        return cursor.lastrowid
+
+    def finish(self, run_id, status, exit_code, result=None):
+        """Record how a run ended."""
+        with self.db:
+            self.db.execute("UPDATE runs SET ended = ?, status = ?, exit_code = ?, result = ? WHERE id = ?",
+                            (time.time(), status, exit_code, json.dumps(result, sort_keys=True), run_id))
+
+    @contextmanager
+    def record(self, job, target):
+        """
+        Record a run around a block of code.
+
+        The block gets a dict to put key results in. An exception marks the
+        run as failed (or timed out) and is re-raised.
+        """
+        run_id = self.start(job, target)
+        result = {}
+        try:
+            yield result
+        except DeadlineExceeded as e:
+            result.setdefault('error', str(e))
+            self.finish(run_id, TIMED_OUT, TIMEOUT_EXIT, result)
+            raise
+        except Exception as e:
+            result.setdefault('error', str(e))
+            self.finish(run_id, FAILED, 1, result)
+            raise
+        self.finish(run_id, SUCCEEDED, 0, result)
+
+    def last_success(self, job, target=None):
+        """Return the most recent successful run of a job (and target)."""
+        query = "SELECT * FROM runs WHERE job = ? AND status = ?"
+        args = [job, SUCCEEDED]
+        if target is not None:
+            query += " AND target = ?"
+            args.append(target)
+        row = self.db.execute(query + " ORDER BY started DESC LIMIT 1", args).fetchone()
+        if row is None:
+            return None
+        run = dict(row)
+        run['result'] = json.loads(run['result']) if run['result'] else None
+        return run
+
+    def is_fresh(self, job, target, max_age):
+        """Whether a successful run of target started in the last max_age seconds."""
+        run = self.last_success(job, target)
+        return run is not None and run['started'] > time.time() - max_age
+
+    def due(self, job, targets, max_age):
+        """
+        Yield the targets that haven't succeeded within max_age seconds.
+
+        max_age can also be a function giving the seconds for a target. Set
+        FORCERUN to process every target regardless.
+        """
+        for target in targets:
+            target_max_age = max_age(target) if callable(max_age) else max_age
+            if not env.get('FORCERUN') and self.is_fresh(job, target, target_max_age):
+                print("Skipping %s, it was checked recently" % target)
+                continue
+            yield target
+
+    def prune(self, max_age):
+        """Forget runs older than max_age seconds to keep the database small."""
+        with self.db:
+            self.db.execute("DELETE FROM runs WHERE started < ?", (time.time() - max_age,))
+
+    def lock(self, job):
+        """
+        Try to take a lock for job, so overlapping invocations of the same
+        job (e.g. a scheduled run and a catch-up run) don't repeat work.
+
+        Returns the lock file (keep it open while running) or None if another
+        invocation holds it.
+        """
+        lock_file = open(path.join(path.dirname(self.path), job + '.lock'), 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            lock_file.close()
+            return None
+        return lock_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show when a job last succeeded.")
+    parser.add_argument('job')
+    parser.add_argument('target', nargs='?')
+    args = parser.parse_args()
+
+    run = RunHistory().last_success(args.job, args.target)
+    if run is None:
+        print("%s has never succeeded" % (args.target or args.job))
+        return 1
+    print("%s last succeeded at %s (took %.1fs): %s" % (
+        run['target'],
+        time.strftime('%Y-%m-%d %H:%M:%SZ', time.gmtime(run['ended'])),
+        run['ended'] - run['started'],
+        json.dumps(run['result'], sort_keys=True)))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
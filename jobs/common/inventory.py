@@ -0,0 +1,140 @@
+"""
+The targets of the jobs and their settings, from an inventory file.
+
+Each line of the file is one target of one kind of job:
+
+    kind target [key=value ...]
+
+for example:
+
+    certexpiry example.com ports=443,8443 days=30 tags=prod
+    ssllabs example.com grade=A+ tags=prod,web
+    httpobs example.com score=80 every=3d
+    repo percipient/strongjobs tags=prod
+
+Blank lines and lines starting with # are ignored. Every kind has its own
+settings (see the jobs), and these apply to all of them:
+
+* tags -- comma separated tags, for running only some targets.
+* every -- how often to check the target, overriding the job's default, in
+  seconds or with a unit like 12h or 7d.
+
+The file is at INVENTORY (default /opt/strongjobs/inventory, downloaded from
+S3 on deploy). It is read a line at a time and only the lines of the wanted
+kind, and with one of the tags in INVENTORYTAGS if set, are parsed. Without
+it, the jobs fall back to their whitespace separated lists in conf.env.
+"""
+
+from __future__ import absolute_import
+
+from collections import OrderedDict
+from os import environ as env, path
+
+
+DEFAULT_PATH = '/opt/strongjobs/inventory'
+
+UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+
+
+def parse_duration(duration):
+    """Parse a duration like "90", "15m" or "7d" into seconds."""
+    duration = duration.strip().lower()
+    if duration and duration[-1] in UNITS:
+        return float(duration[:-1]) * UNITS[duration[-1]]
+    return float(duration)
+
+
+def split_list(value):
+    """Split a comma separated setting, ignoring empty items."""
+    return [item for item in value.split(',') if item]
+
+
+class Entry(object):
+    """A target of a job and its settings."""
+
+    def __init__(self, kind, target, options=None, tags=()):
+        self.kind = kind
+        self.target = target
+        self.options = options or {}
+        self.tags = set(tags)
+
+    def get(self, key, default=None):
+        return self.options.get(key, default)
+
+    def require(self, key):
+        """A setting the target can't be checked without."""
+        if key not in self.options:
+            raise ValueError("%s %s has no %s= setting" % (self.kind, self.target, key))
+        return self.options[key]
+
+    def max_age(self, default):
+        """Seconds a successful check of the target counts as fresh."""
+        every = self.options.get('every')
+        return parse_duration(every) if every else default
+
+
+def parse_line(line):
+    """Parse a line of the inventory (not a comment) into an Entry."""
+    fields = line.split()
+    if len(fields) < 2:
+        raise ValueError("Expected a kind and a target")
+    options = {}
+    for field in fields[2:]:
+        key, sep, value = field.partition('=')
+        if not sep:
+            raise ValueError("Expected key=value, not %s" % field)
+        options[key] = value
+    tags = split_list(options.pop('tags', ''))
+    return Entry(fields[0], fields[1], options, tags)
+
+
+def wanted_tags():
+    """The tags in INVENTORYTAGS, or None for every target."""
+    tags = split_list(env.get('INVENTORYTAGS', ''))
+    return set(tags) if tags else None
+
+
+def read(kind, inventory_path, tags=None):
+    """
+    Yield the entries of kind in an inventory file, only those with one of
+    tags if given.
+    """
+    with open(inventory_path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            # Skip other kinds (and comments) without parsing them.
+            if not line.startswith(kind + ' ') and not line.startswith(kind + '\t'):
+                continue
+            if tags and 'tags=' not in line:
+                continue
+            try:
+                entry = parse_line(line)
+            except ValueError as e:
+                raise ValueError("%s:%d: %s" % (inventory_path, number, e))
+            if tags and not entry.tags & tags:
+                continue
+            yield entry
+
+
+def load(kind, env_name, parse, tags=None):
+    """
+    The entries of kind by target, in the order they are listed.
+
+    They come from the inventory file if there is one, limited to tags (by
+    default INVENTORYTAGS). Otherwise each item in the env_name list is turned
+    into an Entry by parse. Returns None if there are neither.
+    """
+    inventory_path = path.expanduser(env.get('INVENTORY', DEFAULT_PATH))
+    if 'INVENTORY' in env or path.exists(inventory_path):
+        entries = read(kind, inventory_path, wanted_tags() if tags is None else tags)
+    elif env.get(env_name):
+        entries = (parse(item) for item in env[env_name].split())
+    else:
+        return None
+
+    found = OrderedDict()
+    for entry in entries:
+        if entry.target in found:
+            print("%s %s is listed more than once, using the last one" % (kind, entry.target))
+        found[entry.target] = entry
+    return found
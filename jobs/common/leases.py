@@ -0,0 +1,370 @@
+"""
+Split a job's targets between several instances using leases.
+
+Every instance runs the same crontab, so every instance walks the same list of
+targets. Before working on a target an instance has to take its lease. The
+lease record lives in a backend shared by all the instances (a DynamoDB table,
+an S3 bucket, or a directory for a single machine or tests) and is only ever
+changed with a conditional write, so exactly one instance can hold it.
+
+A lease record is one of:
+
+* held: an instance is working on the target. The holder renews it while
+  working; if the holder dies the lease expires and another instance takes it.
+* done: the target was finished recently, so nobody else should repeat it
+  during this run.
+
+Instances keep waiting on targets that are held by others until they are done
+or their lease expires, which is how work from a failed instance gets picked
+up.
+
+Set LEASEBACKEND to enable sharding:
+
+* dynamodb://table -- lease records are items in a DynamoDB table (the stack
+  creates strongjobs-leases).
+* s3://bucket/prefix -- lease records are S3 objects.
+* file:///path/to/dir -- lease records are files in a (shared) directory.
+
+Without it every target is processed locally, as on a single instance.
+"""
+
+from __future__ import absolute_import
+
+import errno
+import fcntl
+import json
+import os
+from os import environ as env, path
+import socket
+import threading
+import time
+import uuid
+
+from deadlines import DeadlineExceeded, NO_DEADLINE
+
+
+# Outcomes of trying to take a lease.
+ACQUIRED = "acquired"
+HELD = "held"
+DONE = "done"
+
+# How long (in seconds) a lease lasts before another instance may take it over.
+DEFAULT_TTL = int(env.get('LEASETTL', 15 * 60))
+# How long a finished target stays finished, unless the job gives its own.
+# Should be longer than a run and shorter than the time between runs.
+DEFAULT_FRESHNESS = int(env.get('LEASEFRESHNESS', 60 * 60))
+# How often to look at targets held by other instances.
+DEFAULT_POLL_INTERVAL = 30
+# First boto3 that can send If-Match on PutObject, which renewing and
+# finishing leases in S3 need.
+MIN_BOTO3 = '1.35.68'
+
+
+class FileBackend(object):
+    """Lease records as JSON files in a directory, guarded by flock."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, key):
+        return path.join(self.directory, key.replace('/', '__') + '.json')
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), 'r') as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def read(self, key):
+        """Return (record, version) for a key, or (None, None)."""
+        data = self._read(key)
+        if data is None:
+            return None, None
+        return json.loads(data), data
+
+    def write(self, key, record, version):
+        """Write record if the key is still at version. Returns success."""
+        with open(self._path(key) + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if self._read(key) != version:
+                    return False
+                tmp_path = '%s.%d.tmp' % (self._path(key), os.getpid())
+                with open(tmp_path, 'w') as f:
+                    f.write(json.dumps(record, sort_keys=True))
+                os.rename(tmp_path, self._path(key))
+                return True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class S3Backend(object):
+    """Lease records as S3 objects, using conditional writes on ETags."""
+
+    def __init__(self, bucket, prefix):
+        # The boto3 in requirements.txt is too old for this backend.
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("The S3 lease backend needs boto3 %s or newer (on Python 3.8+)" % MIN_BOTO3)
+
+        self.s3 = boto3.client('s3')
+        put_object = self.s3.meta.service_model.operation_model('PutObject')
+        if 'IfMatch' not in put_object.input_shape.members:
+            raise RuntimeError("The S3 lease backend needs boto3 %s or newer for conditional writes, not %s" %
+                               (MIN_BOTO3, boto3.__version__))
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+
+    def _key(self, key):
+        return self.prefix + '/' + key if self.prefix else key
+
+    def read(self, key):
+        """Return (record, version) for a key, or (None, None)."""
+        try:
+            res = self.s3.get_object(Bucket=self.bucket, Key=self._key(key))
+        except self.s3.exceptions.NoSuchKey:
+            return None, None
+        return json.loads(res['Body'].read().decode('utf-8')), res['ETag']
+
+    def write(self, key, record, version):
+        """Write record if the key is still at version. Returns success."""
+        from botocore.exceptions import ClientError
+
+        kwargs = {
+            'Bucket': self.bucket,
+            'Key': self._key(key),
+            'Body': json.dumps(record, sort_keys=True).encode('utf-8'),
+        }
+        if version is None:
+            kwargs['IfNoneMatch'] = '*'
+        else:
+            kwargs['IfMatch'] = version
+        try:
+            self.s3.put_object(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+
+
+class DynamoDBBackend(object):
+    """Lease records as DynamoDB items, using conditional writes on a version.
+
+    Conditional writes have been in DynamoDB for long enough that any boto3
+    works, including on Python 2.
+    """
+
+    def __init__(self, table, region=None):
+        import boto3
+
+        self.dynamodb = boto3.client('dynamodb', region_name=region)
+        self.table = table
+
+    def read(self, key):
+        """Return (record, version) for a key, or (None, None)."""
+        res = self.dynamodb.get_item(TableName=self.table, Key={'key': {'S': key}}, ConsistentRead=True)
+        if 'Item' not in res:
+            return None, None
+        item = res['Item']
+        return json.loads(item['record']['S']), item['version']['S']
+
+    def write(self, key, record, version):
+        """Write record if the key is still at version. Returns success."""
+        from botocore.exceptions import ClientError
+
+        kwargs = {
+            'TableName': self.table,
+            'Item': {
+                'key': {'S': key},
+                'record': {'S': json.dumps(record, sort_keys=True)},
+                'version': {'S': uuid.uuid4().hex},
+            },
+        }
+        # Attribute names can clash with reserved words in expressions, so
+        # use placeholders.
+        if version is None:
+            kwargs['ConditionExpression'] = 'attribute_not_exists(#key)'
+            kwargs['ExpressionAttributeNames'] = {'#key': 'key'}
+        else:
+            kwargs['ConditionExpression'] = '#version = :version'
+            kwargs['ExpressionAttributeNames'] = {'#version': 'version'}
+            kwargs['ExpressionAttributeValues'] = {':version': {'S': version}}
+        try:
+            self.dynamodb.put_item(**kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+
+def backend_from_env():
+    """Build the backend named by LEASEBACKEND, or None if it isn't set."""
+    url = env.get('LEASEBACKEND')
+    if not url:
+        return None
+    if url.startswith('dynamodb://'):
+        return DynamoDBBackend(url[len('dynamodb://'):])
+    if url.startswith('s3://'):
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        return S3Backend(bucket, prefix)
+    if url.startswith('file://'):
+        return FileBackend(url[len('file://'):])
+    raise ValueError("Unknown LEASEBACKEND: %s" % url)
+
+
+def default_owner():
+    """Identify this instance (and process) in lease records."""
+    return env.get('LEASEOWNER') or '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class Leases(object):
+    """
+    Take, renew and finish leases on a job's targets.
+
+    freshness is how many seconds a finished target stays done, or a function
+    giving them for a target. Targets finished before done_after are taken
+    again anyway.
+    """
+
+    def __init__(self, backend, job, owner=None, ttl=DEFAULT_TTL, freshness=DEFAULT_FRESHNESS, done_after=0):
+        self.backend = backend
+        self.job = job
+        self.owner = owner or default_owner()
+        self.ttl = ttl
+        self.freshness = freshness
+        self.done_after = done_after
+
+    def _key(self, target):
+        return self.job + '/' + target
+
+    def acquire(self, target):
+        """Try to take the lease on target. Returns ACQUIRED, HELD or DONE."""
+        key = self._key(target)
+        record, version = self.backend.read(key)
+        now = time.time()
+        if record is not None and record['expires'] > now:
+            if record['state'] == 'done':
+                if record.get('finished', 0) >= self.done_after:
+                    return DONE
+            elif record['owner'] != self.owner:
+                return HELD
+        new_record = {'state': 'held', 'owner': self.owner, 'expires': now + self.ttl}
+        if self.backend.write(key, new_record, version):
+            return ACQUIRED
+        # Somebody else got there first.
+        return HELD
+
+    def _replace(self, target, new_record):
+        key = self._key(target)
+        record, version = self.backend.read(key)
+        if record is None or record['owner'] != self.owner or record['state'] != 'held':
+            # We lost the lease, so don't clobber whoever has it now.
+            return False
+        return self.backend.write(key, new_record, version)
+
+    def renew(self, target):
+        """Extend our lease on target. Returns False if it was lost."""
+        return self._replace(target, {'state': 'held', 'owner': self.owner, 'expires': time.time() + self.ttl})
+
+    def complete(self, target, started=None):
+        """
+        Mark target as done so other instances skip it while it is fresh.
+
+        Like the run history, freshness counts from when work on it started.
+        """
+        freshness = self.freshness(target) if callable(self.freshness) else self.freshness
+        now = time.time()
+        expires = (started or now) + freshness
+        return self._replace(target, {'state': 'done', 'owner': self.owner, 'finished': now, 'expires': expires})
+
+    def release(self, target):
+        """Give up our lease on target so another instance can take it."""
+        return self._replace(target, {'state': 'held', 'owner': self.owner, 'expires': 0})
+
+
+class _Heartbeat(threading.Thread):
+    """Renew a lease in the background while its target is being worked on."""
+
+    def __init__(self, leases, target):
+        super(_Heartbeat, self).__init__()
+        self.daemon = True
+        self.leases = leases
+        self.target = target
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.leases.ttl / 3.0):
+            if not self.leases.renew(self.target):
+                print("Lost lease on %s" % self.target)
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def shard(job, targets, backend=None, poll_interval=DEFAULT_POLL_INTERVAL, deadline=NO_DEADLINE, **kwargs):
+    """
+    Yield the targets this instance should process.
+
+    Each yielded target is leased until the caller asks for the next one, at
+    which point it is marked as done. If the caller sends False instead (e.g.
+    the target timed out) or stops early (e.g. an exception), the lease is
+    released so another instance can try it. Waiting on targets held by other
+    instances stops at the deadline with DeadlineExceeded.
+
+    Without a backend (and no LEASEBACKEND) all targets are yielded.
+    """
+    if backend is None:
+        backend = backend_from_env()
+    if backend is None:
+        for target in targets:
+            yield target
+        return
+
+    leases = Leases(backend, job, **kwargs)
+    pending = list(targets)
+    while pending:
+        waiting = []
+        for target in pending:
+            result = leases.acquire(target)
+            if result == HELD:
+                waiting.append(target)
+                continue
+            if result == DONE:
+                continue
+
+            heartbeat = _Heartbeat(leases, target)
+            heartbeat.start()
+            started = time.time()
+            try:
+                succeeded = yield target
+            except BaseException:
+                heartbeat.stop()
+                leases.release(target)
+                raise
+            heartbeat.stop()
+            if succeeded is False:
+                leases.release(target)
+            else:
+                leases.complete(target, started)
+
+        pending = waiting
+        if pending:
+            if deadline.expired():
+                raise DeadlineExceeded("Ran out of time waiting on other instances for %s" % " ".join(pending))
+            print("Waiting on %d target(s) held by other instances" % len(pending))
+            remaining = deadline.remaining()
+            time.sleep(poll_interval if remaining is None else min(poll_interval, remaining))
@@ -0,0 +1,113 @@
+"""
+The loop shared by every job: process each due target once, within its time
+budget, and record how it went.
+"""
+
+from __future__ import absolute_import
+
+from os import environ as env
+import time
+import traceback
+
+from deadlines import Deadline, DeadlineExceeded, seconds_from_env, TIMEOUT_EXIT
+from history import RunHistory
+from leases import shard
+
+
+def run_targets(job, targets, work, max_age, before=None, after=None):
+    """
+    Call work(target, deadline, result) for each target and return the job's
+    exit code.
+
+    Targets that succeeded within max_age seconds (or max_age(target), if it
+    is a function) are skipped, and when running on several instances each
+    target is handled by only one of them.
+    work gets the target's Deadline and a dict to put key results in, which
+    are kept in the run history even if it runs out of time. before, if given,
+    is called with the list of due targets before any are processed, and
+    after once they have been. Both are only called while holding the job's
+    lock.
+
+    Targets that run out of time or fail are reported and the job carries on
+    with the next one. The job then exits with 1 if any failed, or otherwise
+    TIMEOUT_EXIT if any ran out of time (or it ran out of time waiting on
+    other instances).
+    """
+    history = RunHistory()
+    lock = history.lock(job)
+    if lock is None:
+        print("%s is already running" % job)
+        return 0
+
+    job_deadline = Deadline.from_env("JOBDEADLINE")
+    target_seconds = seconds_from_env("TARGETDEADLINE")
+
+    due = list(history.due(job, targets, max_age))
+    if before is not None:
+        before(due)
+
+    done = []
+    timed_out = []
+    failed = []
+    waited_out = False
+    # Other instances skip targets for as long as they are fresh here, since
+    # each instance only knows about its own runs. With FORCERUN, only
+    # targets done during this run are skipped.
+    targets = shard(job, due, deadline=job_deadline, freshness=max_age,
+                    done_after=time.time() if env.get('FORCERUN') else 0)
+    succeeded = None
+    while True:
+        try:
+            target = targets.send(succeeded)
+        except StopIteration:
+            break
+        except DeadlineExceeded as e:
+            # Whichever instance holds them carries on with the rest.
+            print("%s: %s" % (job, e))
+            waited_out = True
+            break
+        if job_deadline.expired():
+            print("%s ran out of time before %s" % (job, target))
+            timed_out.append(target)
+            # Stopping here gives the lease back to other instances.
+            targets.close()
+            break
+        deadline = job_deadline.child(target_seconds)
+        try:
+            with history.record(job, target) as result:
+                try:
+                    work(target, deadline, result)
+                except Exception as e:
+                    # Timeouts of HTTP requests, sockets etc. that were cut
+                    # short by the deadline count as running out of time.
+                    if deadline.expired() and not isinstance(e, DeadlineExceeded):
+                        raise DeadlineExceeded(str(e))
+                    raise
+        except DeadlineExceeded as e:
+            print("Timed out on %s: %s" % (target, e))
+            timed_out.append(target)
+            # Let another instance try it.
+            succeeded = False
+        except Exception as e:
+            print("Failed on %s: %s" % (target, e))
+            traceback.print_exc()
+            failed.append(target)
+            # Another instance would most likely fail the same way, so don't
+            # hand it over.
+            succeeded = True
+        else:
+            done.append(target)
+            succeeded = True
+
+    if after is not None:
+        after()
+
+    print("%s finished %d target(s)" % (job, len(done)))
+    if timed_out:
+        print("%s timed out on: %s" % (job, " ".join(timed_out)))
+    if failed:
+        print("%s failed on: %s" % (job, " ".join(failed)))
+        return 1
+    if timed_out or waited_out:
+        return TIMEOUT_EXIT
+    return 0
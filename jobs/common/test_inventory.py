@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from inventory import Entry, load, parse_duration, read
+
+
+INVENTORY = """\
+# A comment
+certexpiry a.com ports=443,8443 days=30 tags=prod
+  certexpiry b.com
+certexpiry\tc.com tags=dev every=12h
+certexpiryother d.com
+ssllabs a.com grade=A+ tags=prod
+"""
+
+
+class InventoryTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'inventory')
+        with open(self.path, 'w') as f:
+            f.write(INVENTORY)
+
+    def test_read(self):
+        entries = list(read('certexpiry', self.path))
+        self.assertEqual([entry.target for entry in entries], ['a.com', 'b.com', 'c.com'])
+        self.assertEqual(entries[0].options, {'ports': '443,8443', 'days': '30'})
+        self.assertEqual(entries[0].tags, set(['prod']))
+
+    def test_tags(self):
+        self.assertEqual([entry.target for entry in read('certexpiry', self.path, set(['dev']))], ['c.com'])
+
+    def test_max_age(self):
+        entries = dict((entry.target, entry) for entry in read('certexpiry', self.path))
+        self.assertEqual(entries['a.com'].max_age(60), 60)
+        self.assertEqual(entries['c.com'].max_age(60), 12 * 60 * 60)
+
+    def test_malformed(self):
+        with open(self.path, 'a') as f:
+            f.write('ssllabs b.com grade\n')
+        with self.assertRaises(ValueError):
+            list(read('ssllabs', self.path))
+
+    def test_load_falls_back_to_env(self):
+        if os.path.exists('/opt/strongjobs/inventory'):
+            self.skipTest('An inventory is installed')
+        environ = dict(os.environ)
+        self.addCleanup(os.environ.update, environ)
+        self.addCleanup(os.environ.clear)
+        os.environ.pop('INVENTORY', None)
+        os.environ['INVENTORY_TEST_LIST'] = 'x.com y.com'
+        entries = load('nothing', 'INVENTORY_TEST_LIST', lambda item: Entry('nothing', item))
+        self.assertEqual(list(entries), ['x.com', 'y.com'])
+
+    def test_load_expands_home(self):
+        environ = dict(os.environ)
+        self.addCleanup(os.environ.update, environ)
+        self.addCleanup(os.environ.clear)
+        os.environ['HOME'] = os.path.dirname(self.path)
+        os.environ['INVENTORY'] = '~/inventory'
+        self.assertEqual(list(load('certexpiry', 'CERTEXPIRELIST', None)), ['a.com', 'b.com', 'c.com'])
+
+    def test_parse_duration(self):
+        self.assertEqual(parse_duration('90'), 90)
+        self.assertEqual(parse_duration('7d'), 7 * 24 * 60 * 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
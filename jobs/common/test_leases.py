@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import boto3
+from moto import mock_aws
+
+from deadlines import Deadline, DeadlineExceeded
+from leases import ACQUIRED, DONE, DynamoDBBackend, FileBackend, HELD, Leases, shard
+
+
+class LeasesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = FileBackend(self.directory)
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def leases(self, owner, **kwargs):
+        return Leases(self.backend, 'job', owner=owner, **kwargs)
+
+    def test_acquire(self):
+        self.assertEqual(self.leases('a').acquire('example.com'), ACQUIRED)
+
+    def test_held_by_another_instance(self):
+        self.leases('a').acquire('example.com')
+        self.assertEqual(self.leases('b').acquire('example.com'), HELD)
+        # The holder can take it again.
+        self.assertEqual(self.leases('a').acquire('example.com'), ACQUIRED)
+
+    def test_expired_lease_is_taken_over(self):
+        a = self.leases('a', ttl=0.1)
+        a.acquire('example.com')
+        time.sleep(0.2)
+        self.assertEqual(self.leases('b').acquire('example.com'), ACQUIRED)
+        # The old holder can't renew or finish it any more.
+        self.assertFalse(a.renew('example.com'))
+        self.assertFalse(a.complete('example.com'))
+
+    def test_renew(self):
+        a = self.leases('a', ttl=0.2)
+        a.acquire('example.com')
+        time.sleep(0.1)
+        self.assertTrue(a.renew('example.com'))
+        time.sleep(0.15)
+        self.assertEqual(self.leases('b').acquire('example.com'), HELD)
+
+    def test_complete(self):
+        a = self.leases('a')
+        a.acquire('example.com')
+        self.assertTrue(a.complete('example.com'))
+        self.assertEqual(self.leases('b').acquire('example.com'), DONE)
+
+    def test_done_expires(self):
+        a = self.leases('a', freshness=0.1)
+        a.acquire('example.com')
+        a.complete('example.com')
+        time.sleep(0.2)
+        self.assertEqual(self.leases('b').acquire('example.com'), ACQUIRED)
+
+    def test_freshness_per_target(self):
+        a = self.leases('a', freshness=lambda target: 0.1 if target == 'short' else 60)
+        for target in ['short', 'long']:
+            a.acquire(target)
+            a.complete(target)
+        time.sleep(0.2)
+        self.assertEqual(self.leases('b').acquire('short'), ACQUIRED)
+        self.assertEqual(self.leases('b').acquire('long'), DONE)
+
+    def test_done_before_forced_run(self):
+        a = self.leases('a')
+        a.acquire('example.com')
+        a.complete('example.com')
+        self.assertEqual(self.leases('b', done_after=time.time()).acquire('example.com'), ACQUIRED)
+
+    def test_release(self):
+        a = self.leases('a')
+        a.acquire('example.com')
+        self.assertTrue(a.release('example.com'))
+        self.assertEqual(self.leases('b').acquire('example.com'), ACQUIRED)
+
+    def test_stale_write_fails(self):
+        record, version = self.backend.read('key')
+        self.assertTrue(self.backend.write('key', {'n': 1}, version))
+        self.assertFalse(self.backend.write('key', {'n': 2}, version))
+        self.assertEqual(self.backend.read('key')[0], {'n': 1})
+
+
+class DynamoDBBackendTest(unittest.TestCase):
+    def setUp(self):
+        environ = os.environ.copy()
+        self.addCleanup(os.environ.update, environ)
+        self.addCleanup(os.environ.clear)
+        os.environ.update(AWS_ACCESS_KEY_ID="testing", AWS_SECRET_ACCESS_KEY="testing")
+        mock = mock_aws()
+        mock.start()
+        self.addCleanup(mock.stop)
+        # Like the table in CloudFormation.py
+        boto3.client('dynamodb', region_name='us-east-1').create_table(
+            TableName='leases',
+            AttributeDefinitions=[{'AttributeName': 'key', 'AttributeType': 'S'}],
+            KeySchema=[{'AttributeName': 'key', 'KeyType': 'HASH'}],
+            ProvisionedThroughput={'ReadCapacityUnits': 1, 'WriteCapacityUnits': 1},
+        )
+        self.backend = DynamoDBBackend('leases', 'us-east-1')
+
+    def test_stale_write_fails(self):
+        record, version = self.backend.read('job/key')
+        self.assertIsNone(record)
+        self.assertTrue(self.backend.write('job/key', {'n': 1}, version))
+        self.assertFalse(self.backend.write('job/key', {'n': 2}, version))
+        record, version = self.backend.read('job/key')
+        self.assertEqual(record, {'n': 1})
+        self.assertTrue(self.backend.write('job/key', {'n': 3}, version))
+        self.assertFalse(self.backend.write('job/key', {'n': 4}, version))
+        self.assertEqual(self.backend.read('job/key')[0], {'n': 3})
+
+    def test_leases(self):
+        a = Leases(self.backend, 'job', owner='a')
+        self.assertEqual(a.acquire('example.com'), ACQUIRED)
+        self.assertEqual(Leases(self.backend, 'job', owner='b').acquire('example.com'), HELD)
+        self.assertTrue(a.complete('example.com'))
+        self.assertEqual(Leases(self.backend, 'job', owner='b').acquire('example.com'), DONE)
+
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = FileBackend(self.directory)
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_targets_are_split(self):
+        first = shard('job', ['a', 'b'], self.backend, owner='one', poll_interval=0.01)
+        self.assertEqual(next(first), 'a')
+        # While the first instance works on a, the second gets b.
+        second = shard('job', ['a', 'b'], self.backend, owner='two', poll_interval=0.01)
+        self.assertEqual(next(second), 'b')
+        # Both then wait for the other's target to be done, and find nothing
+        # left to do.
+        rest = []
+        thread = threading.Thread(target=lambda: rest.extend(second))
+        thread.start()
+        self.assertEqual(list(first), [])
+        thread.join()
+        self.assertEqual(rest, [])
+
+    def test_waiting_stops_at_the_deadline(self):
+        first = shard('job', ['a'], self.backend, owner='one')
+        next(first)
+        start = time.time()
+        second = shard('job', ['a'], self.backend, owner='two', poll_interval=60, deadline=Deadline(0.1))
+        self.assertRaises(DeadlineExceeded, list, second)
+        self.assertLess(time.time() - start, 5)
+
+    def test_failed_target_is_released(self):
+        first = shard('job', ['a'], self.backend, owner='one')
+        next(first)
+        self.assertRaises(ValueError, first.throw, ValueError())
+        self.assertEqual(list(shard('job', ['a'], self.backend, owner='two')), ['a'])
+
+    def test_failed_target_is_given_back(self):
+        first = shard('job', ['a'], self.backend, owner='one')
+        next(first)
+        self.assertRaises(StopIteration, first.send, False)
+        self.assertEqual(list(shard('job', ['a'], self.backend, owner='two')), ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from deadlines import DeadlineExceeded, TIMEOUT_EXIT
+from history import FAILED, RunHistory, SUCCEEDED, TIMED_OUT
+from runner import run_targets
+
+
+class RunTargetsTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        environ = dict(os.environ)
+        self.addCleanup(os.environ.update, environ)
+        self.addCleanup(os.environ.clear)
+        os.environ['RUNHISTORY'] = os.path.join(directory, 'history.sqlite')
+        for name in ['FORCERUN', 'JOBDEADLINE', 'TARGETDEADLINE', 'LEASEBACKEND']:
+            os.environ.pop(name, None)
+        self.done = []
+
+    def work(self, target, deadline, result):
+        if target == 'broken':
+            raise ValueError("Broken")
+        if target == 'slow':
+            raise DeadlineExceeded("Too slow")
+        self.done.append(target)
+
+    def status(self, target):
+        row = RunHistory().db.execute("SELECT status FROM runs WHERE job = 'job' AND target = ?",
+                                      (target,)).fetchone()
+        return row['status']
+
+    def test_failed_target_doesnt_stop_the_job(self):
+        after = []
+        exit_code = run_targets('job', ['a', 'broken', 'b'], self.work, 60, after=lambda: after.append(True))
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(self.done, ['a', 'b'])
+        self.assertEqual(after, [True])
+        self.assertEqual(self.status('broken'), FAILED)
+        self.assertEqual(self.status('b'), SUCCEEDED)
+
+    def test_timed_out_target(self):
+        self.assertEqual(run_targets('job', ['slow', 'a'], self.work, 60), TIMEOUT_EXIT)
+        self.assertEqual(self.done, ['a'])
+        self.assertEqual(self.status('slow'), TIMED_OUT)
+
+
+if __name__ == '__main__':
+    unittest.main()
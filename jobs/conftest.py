@@ -0,0 +1,5 @@
+import sys
+from os import path
+
+# The crontab puts the shared modules on PYTHONPATH for the jobs.
+sys.path.insert(0, path.join(path.dirname(__file__), 'common'))
@@ -3,54 +3,160 @@
 from __future__ import absolute_import
 
 import datetime
+from multiprocessing.pool import ThreadPool
 from os import environ as env
 import socket
 
-from OpenSSL import SSL
+from cryptography import x509
 
-from utils import createIssue
+from deadlines import NO_DEADLINE
+from inventory import Entry, load, split_list
+from runner import run_targets
+from utils import alertSink, DnsCache, escapeCell, IssueAlerts, tlsHandshake
 
 EXPIREDAYS = 90
+# Don't check a host again within this many seconds (runs daily)
+MAXAGE = 24 * 60 * 60 - 15 * 60
+# Ports to check on every address of a host, unless its entry gives its own
+DEFAULTPORTS = [443]
+# How many endpoints to check at the same time
+CONCURRENCY = 8
 
 
-def checkHost(hostName):
-    """Get cert on host and create issue if nearing expiration."""
+def parseEntry(item):
+    """Turn a CERTEXPIRELIST item (host or host:port,port) into an inventory entry."""
+    hostName, _, ports = item.partition(":")
+    return Entry("certexpiry", hostName, {"ports": ports} if ports else {})
+
+
+def entryPorts(entry):
+    ports = split_list(entry.get("ports", ""))
+    return [int(port) for port in ports] if ports else DEFAULTPORTS
+
+
+def formatEndpoint(address, port):
+    if ":" in address:
+        return "[%s]:%d" % (address, port)
+    return "%s:%d" % (address, port)
+
+
+def daysUntilExpiry(cert):
+    return int((datetime.datetime.strptime(cert.get_notAfter().decode("ascii"),
+                                           "%Y%m%d%H%M%SZ") -
+                datetime.datetime.utcnow()).days)
+
+
+def certName(cert):
+    """Name a certificate by its common name, or failing that its SANs or subject."""
+    subject = cert.get_subject()
+    if subject.CN:
+        return subject.CN
+    # Certificates may only name their hosts in the subject alternative names
+    try:
+        names = cert.to_cryptography().extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+        hostNames = names.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        hostNames = []
+    if hostNames:
+        return ", ".join(hostNames)
+    components = subject.get_components()
+    if components:
+        return "/".join("%s=%s" % (key.decode("utf-8"), value.decode("utf-8")) for key, value in components)
+    return "(no subject)"
+
+
+def checkEndpoint(hostName, address, port, deadline=NO_DEADLINE):
+    """Find the certificate that expires first in the chain an endpoint serves."""
+    endpoint = {"endpoint": formatEndpoint(address, port)}
+    try:
+        handshake = tlsHandshake(hostName, deadline, port, address)
+    except Exception as e:
+        # Report it with the others rather than losing the whole host
+        endpoint["error"] = str(e)
+        return endpoint
+    chain = handshake["chain"] or [handshake["cert"]]
+    # notAfter is formatted so that it sorts by date
+    cert = min(chain, key=lambda cert: cert.get_notAfter())
+    endpoint["subject"] = certName(cert)
+    endpoint["daysLeft"] = daysUntilExpiry(cert)
+    return endpoint
+
+
+def endpointTable(endpoints, worst):
+    """Make a Markdown table of endpoints, highlighting the worst one."""
+    lines = ["| Endpoint | Certificate expiring first | Days left |",
+             "| --- | --- | --- |"]
+    for endpoint in endpoints:
+        if "error" in endpoint:
+            cells = [endpoint["endpoint"], "Error: " + endpoint["error"], ""]
+        else:
+            cells = [endpoint["endpoint"], endpoint["subject"], endpoint["daysLeft"]]
+        cells = [escapeCell(cell) for cell in cells]
+        if endpoint is worst:
+            cells = ["**%s**" % cell for cell in cells]
+        lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines)
+
+
+def checkHost(entry, deadline=NO_DEADLINE, dns=None, pool=None, alerts=None):
+    """Get certs on every endpoint of host and alert if any is nearing expiration.
+
+    Returns the endpoints that were checked and the one expiring first.
+    """
+    hostName = entry.target
+    ports = entryPorts(entry)
+    expireDays = int(entry.get("days", EXPIREDAYS))
     print("Checking " + hostName)
-    # Initialize openssl context
-    ctx = SSL.Context(SSL.TLSv1_2_METHOD)
-    # Connect to server
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sslSock = SSL.Connection(ctx, sock)
-    sslSock.connect((hostName, 443))
-    # Extract the certificate from openssl
-    sslSock.do_handshake()
-    cert = sslSock.get_peer_certificate()
-    # Clean up
-    sslSock.shutdown()
-    sock.close()
-
-    daysLeft = int((datetime.datetime.strptime(cert.get_notAfter(),
-                                               "%Y%m%d%H%M%SZ") -
-                    datetime.datetime.utcnow()).days)
-    print("Certificate for %s has %d days until expiring" %
-          (hostName, daysLeft))
+    dns = dns or DnsCache()
+    alerts = alerts or IssueAlerts()
+    ownPool = pool is None
+    if ownPool:
+        pool = ThreadPool(CONCURRENCY)
+    try:
+        endpoints = pool.map(lambda addressPort: checkEndpoint(hostName, addressPort[0], addressPort[1], deadline),
+                             [(address, port) for address in dns.resolve(hostName) for port in ports])
+    finally:
+        if ownPool:
+            pool.close()
+            pool.join()
+    # Endpoints may have failed because we ran out of time
+    deadline.check()
+
+    for endpoint in endpoints:
+        if "error" in endpoint:
+            print("Couldn't check %s on %s: %s" % (hostName, endpoint["endpoint"], endpoint["error"]))
+        else:
+            print("Certificate for %s on %s has %d days until expiring" %
+                  (hostName, endpoint["endpoint"], endpoint["daysLeft"]))
+    checked = [endpoint for endpoint in endpoints if "error" not in endpoint]
+    if not checked:
+        raise RuntimeError("Couldn't check any endpoint of " + hostName)
+    worst = min(checked, key=lambda endpoint: endpoint["daysLeft"])
+    daysLeft = worst["daysLeft"]
+    body = ("It has %d days until it expires (%s on %s).\n\n%s" %
+            (daysLeft, worst["subject"], worst["endpoint"], endpointTable(endpoints, worst)))
+
+    cells = [worst["endpoint"], worst["subject"], daysLeft]
+    issues = []
 
     # The cert is close to expiration, so we create a GitHub issue
-    if daysLeft <= EXPIREDAYS:
+    if daysLeft <= expireDays:
         print(hostName + " is close to expiring")
-        createIssue(env["ISSUEREPOPATH"],
-                    env["OAUTHTOKEN"],
-                    "Certificate for " + hostName + " is nearing expiration",
-                    "It has %d days until it expires." % daysLeft)
+        issues.append(("Certificate for " + hostName + " is nearing expiration", body))
 
     # The cert is even closer to expiration, so we create a duplicate, more
     # emphatic GitHub issue
-    if daysLeft <= EXPIREDAYS * 2 / 3:
+    if daysLeft <= expireDays * 2 / 3:
         print(hostName + " is very close to expiring")
-        createIssue(env["ISSUEREPOPATH"],
-                    env["OAUTHTOKEN"],
-                    "CERTIFICATE FOR " + hostName + " IS NEARING EXPIRATION!",
-                    "It has %d days until it expires." % daysLeft)
+        issues.append(("CERTIFICATE FOR " + hostName + " IS NEARING EXPIRATION!", body))
+        cells[2] = "**%d**" % daysLeft
+
+    if issues:
+        alerts.finding(hostName, cells, issues)
+    else:
+        alerts.ok(hostName)
+
+    return endpoints, worst
 
 
 def main():
@@ -61,13 +167,41 @@ def main():
     if "OAUTHTOKEN" not in env:
         print("Export GitHub OAuth token as OAUTHTOKEN")
         return 1
-    if "CERTEXPIRELIST" not in env:
-        print("Export hostnames to check for certificate expiry as "
+    entries = load("certexpiry", "CERTEXPIRELIST", parseEntry)
+    if entries is None:
+        print("Add certexpiry hosts to the inventory or export them as "
               "CERTEXPIRELIST")
         return 1
 
-    for hostName in env["CERTEXPIRELIST"].split():
-        checkHost(hostName)
+    # Shared by all hosts in this run
+    dns = DnsCache()
+    pool = ThreadPool(CONCURRENCY)
+
+    def resolveAll(hostNames):
+        # Resolve every host up front, at the same time. Failures show up
+        # again when the host is checked.
+        def resolve(hostName):
+            try:
+                dns.resolve(hostName)
+            except socket.error:
+                pass
+        pool.map(resolve, hostNames)
+
+    alerts = alertSink("certexpiry", ["Endpoint", "Certificate expiring first", "Days left"], list(entries))
+
+    def check(hostName, deadline, result):
+        endpoints, worst = checkHost(entries[hostName], deadline, dns, pool, alerts)
+        result["endpoints"] = endpoints
+        result["daysLeft"] = worst["daysLeft"]
+
+    # Only report once every host has been checked, and not when the job is
+    # already running elsewhere.
+    try:
+        return run_targets("certexpiry", list(entries), check,
+                           lambda hostName: entries[hostName].max_age(MAXAGE), resolveAll, alerts.flush)
+    finally:
+        pool.close()
+        pool.join()
 
 
 if __name__ == "__main__":
@@ -1,41 +1,55 @@
 #!/usr/bin/env python
 
 from os import environ as env
-from time import sleep
 
 import requests
 
-from utils import createIssue
+from deadlines import NO_DEADLINE
+from inventory import Entry, load
+from runner import run_targets
+from utils import alertSink, assess, HTTPTIMEOUT, IssueAlerts
 
 API_URL = "https://http-observatory.security.mozilla.org/api/v1"
+# Don't scan a host again within this many seconds (runs weekly)
+MAXAGE = 7 * 24 * 60 * 60 - 15 * 60
 
 
-def getScore(host):
+def getScore(host, deadline=NO_DEADLINE):
     res = requests.post(API_URL + '/analyze?host={host}'.format(host=host),
-                        data={"hidden": "true"}).json()
+                        data={"hidden": "true"},
+                        timeout=deadline.timeout(HTTPTIMEOUT)).json()
     while res["state"] != "FINISHED":
         print("Status: " + res["state"])
-        sleep(10)
+        deadline.sleep(10)
         res = requests.post(API_URL + '/analyze?host={host}'.format(host=host),
-                            data={"hidden": "true"}).json()
-    print res
+                            data={"hidden": "true"},
+                            timeout=deadline.timeout(HTTPTIMEOUT)).json()
+    print(res)
     return int(res["score"])
 
 
-def check(s):
-    hostName, desiredScore = s.split(';')
-    desiredScore = int(desiredScore)
+def parseEntry(item):
+    """Turn a HTTPOBSLIST item (host;score) into an inventory entry."""
+    hostName, score = item.split(';')
+    return Entry("httpobs", hostName, {"score": score})
+
+
+def check(entry, deadline, result, alerts=None):
+    alerts = alerts or IssueAlerts()
+    hostName = entry.target
+    desiredScore = int(entry.require("score"))
     print("Starting Mozilla Observatory scan for " + hostName)
-    score = getScore(hostName)
+    # Only rescan if something changed or the last scan is too old
+    score = assess("httpobs", hostName, hostName, deadline, result, getScore)
     if score < desiredScore:
         print("Mozilla Observatory scan failed for {}. "
               "Score is now {}, not {}.".format(hostName, score, desiredScore))
-        createIssue(env["ISSUEREPOPATH"],
-                    env["OAUTHTOKEN"],
-                    "Mozilla Observatory score fell for " + hostName,
-                    "Score is now {}, not {}.".format(score, desiredScore))
+        alerts.finding(hostName, [score, desiredScore],
+                       [("Mozilla Observatory score fell for " + hostName,
+                         "Score is now {}, not {}.".format(score, desiredScore))])
     else:
         print("Mozilla Observatory scan passed for " + hostName)
+        alerts.ok(hostName)
 
 
 def main():
@@ -46,13 +60,18 @@ def main():
     if "OAUTHTOKEN" not in env:
         print("Export GitHub OAuth token as OAUTHTOKEN")
         return 1
-    if "HTTPOBSLIST" not in env:
-        print("Export hostnames and scores to check with Mozilla Observatory "
+    entries = load("httpobs", "HTTPOBSLIST", parseEntry)
+    if entries is None:
+        print("Add httpobs hosts and scores to the inventory or export them "
               "as HTTPOBSLIST")
         return 1
 
-    for hostName in env["HTTPOBSLIST"].split():
-        check(hostName)
+    alerts = alertSink("httpobs", ["Score", "Expected"], list(entries))
+    # Only report once every target has been processed, and not when the
+    # job is already running elsewhere.
+    return run_targets("httpobs", list(entries),
+                       lambda hostName, deadline, result: check(entries[hostName], deadline, result, alerts),
+                       lambda hostName: entries[hostName].max_age(MAXAGE), after=alerts.flush)
 
 
 if __name__ == "__main__":
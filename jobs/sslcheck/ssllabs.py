@@ -1,41 +1,56 @@
 #!/usr/bin/env python
 
 from os import environ as env
-from time import sleep
 
 import requests
 
-from utils import createIssue
+from deadlines import NO_DEADLINE
+from inventory import Entry, load
+from runner import run_targets
+from utils import alertSink, assess, HTTPTIMEOUT, IssueAlerts
 
 API_URL = "https://api.ssllabs.com/api/v2/"
+# Don't scan a host again within this many seconds (runs weekly)
+MAXAGE = 7 * 24 * 60 * 60 - 15 * 60
 
 
-def getGrades(host):
+def getGrades(host, deadline=NO_DEADLINE):
     res = requests.get("{api_url}analyze?host={host}&startNew=on".format(
-            api_url=API_URL, host=host)).json()
+            api_url=API_URL, host=host),
+            timeout=deadline.timeout(HTTPTIMEOUT)).json()
     while res["status"] != "READY":
         print("Status: " + res["status"])
-        sleep(10)
+        deadline.sleep(10)
         res = requests.get("{api_url}analyze?host={host}&startNew=off".format(
-                api_url=API_URL, host=host)).json()
+                api_url=API_URL, host=host),
+                timeout=deadline.timeout(HTTPTIMEOUT)).json()
     return [endpoint["grade"] for endpoint in res["endpoints"]]
 
 
-def check(s):
-    hostName, desiredGrade = s.split(';')
+def parseEntry(item):
+    """Turn a SSLLABSLIST item (host;grade) into an inventory entry."""
+    hostName, grade = item.split(';')
+    return Entry("ssllabs", hostName, {"grade": grade})
+
+
+def check(entry, deadline, result, alerts=None):
+    alerts = alerts or IssueAlerts()
+    hostName = entry.target
+    desiredGrade = entry.require("grade")
     print("Starting SSL Labs scan for " + hostName)
-    grades = getGrades(hostName)
+    # Only rescan if something changed or the last scan is too old
+    grades = assess("ssllabs", hostName, hostName, deadline, result, getGrades)
     for newGrade in grades:
         if newGrade != desiredGrade:
             print("SSL Labs scan failed for " + hostName)
-            createIssue(env["ISSUEREPOPATH"],
-                        env["OAUTHTOKEN"],
-                        "SSL Labs Grade fell for " + hostName,
-                        "Grade is now {}, not {}.".format(newGrade,
-                                                          desiredGrade))
+            alerts.finding(hostName, [newGrade, desiredGrade],
+                           [("SSL Labs Grade fell for " + hostName,
+                             "Grade is now {}, not {}.".format(newGrade,
+                                                               desiredGrade))])
             break
     else:
         print("SSL Labs scan passed for " + hostName)
+        alerts.ok(hostName)
 
 
 def main():
@@ -46,13 +61,18 @@ def main():
     if "OAUTHTOKEN" not in env:
         print("Export GitHub OAuth token as OAUTHTOKEN")
         return 1
-    if "SSLLABSLIST" not in env:
-        print("Export hostnames and grades to check with SSL Labs as "
-              "SSLLABSLIST")
+    entries = load("ssllabs", "SSLLABSLIST", parseEntry)
+    if entries is None:
+        print("Add ssllabs hosts and grades to the inventory or export them "
+              "as SSLLABSLIST")
         return 1
 
-    for hostName in env["SSLLABSLIST"].split():
-        check(hostName)
+    alerts = alertSink("ssllabs", ["Grade", "Expected"], list(entries))
+    # Only report once every target has been processed, and not when the
+    # job is already running elsewhere.
+    return run_targets("ssllabs", list(entries),
+                       lambda hostName, deadline, result: check(entries[hostName], deadline, result, alerts),
+                       lambda hostName: entries[hostName].max_age(MAXAGE), after=alerts.flush)
 
 
 if __name__ == "__main__":
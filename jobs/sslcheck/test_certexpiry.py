@@ -0,0 +1,53 @@
+import datetime
+import unittest
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from OpenSSL import crypto
+
+import certexpiry
+
+
+def makeCert(attributes, hostNames=None):
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(oid, value) for oid, value in attributes])
+    now = datetime.datetime.utcnow()
+    builder = (x509.CertificateBuilder()
+               .subject_name(name)
+               .issuer_name(name)
+               .public_key(key.public_key())
+               .serial_number(1)
+               .not_valid_before(now)
+               .not_valid_after(now + datetime.timedelta(days=10)))
+    if hostNames:
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(h) for h in hostNames]), False)
+    return crypto.X509.from_cryptography(builder.sign(key, hashes.SHA256(), default_backend()))
+
+
+class CertNameTest(unittest.TestCase):
+    def test_common_name(self):
+        self.assertEqual(certexpiry.certName(makeCert([(NameOID.COMMON_NAME, u"example.com")])), "example.com")
+
+    def test_alternative_names_only(self):
+        cert = makeCert([], ["example.com", "www.example.com"])
+        self.assertEqual(certexpiry.certName(cert), "example.com, www.example.com")
+
+    def test_subject_without_common_name(self):
+        cert = makeCert([(NameOID.ORGANIZATION_NAME, u"Example")])
+        self.assertEqual(certexpiry.certName(cert), "O=Example")
+
+
+class EndpointTableTest(unittest.TestCase):
+    def test_cells_are_escaped(self):
+        endpoints = [{"endpoint": "1.2.3.4:443", "subject": "DNS:a|b", "daysLeft": 5},
+                     {"endpoint": "1.2.3.5:443", "error": "Connection\nrefused"}]
+        table = certexpiry.endpointTable(endpoints, endpoints[0])
+        self.assertEqual(table.splitlines()[2:], ["| **1.2.3.4:443** | **DNS:a\\|b** | **5** |",
+                                                  "| 1.2.3.5:443 | Error: Connection refused |  |"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,166 @@
+import json
+import os
+import unittest
+
+import requests
+
+import utils
+
+
+class FakeCert(object):
+    def digest(self, name):
+        return b"AB:CD"
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None, data=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+
+def patch(testCase, module, name, value):
+    original = getattr(module, name)
+    setattr(module, name, value)
+    testCase.addCleanup(setattr, module, name, original)
+
+
+class FingerprintTest(unittest.TestCase):
+    def setUp(self):
+        self.assessments = []
+        self.lastResult = None
+        patch(self, utils, "tlsHandshake", self.tlsHandshake)
+        patch(self, utils.requests, "get", self.get)
+        test = self
+
+        class History(object):
+            def last_success(self, job, target):
+                return {"result": test.lastResult} if test.lastResult else None
+
+        patch(self, utils, "RunHistory", History)
+
+    def tlsHandshake(self, hostName, deadline):
+        return {"cert": FakeCert(), "protocol": "TLSv1.2", "cipher": "ECDHE-RSA-AES128-GCM-SHA256"}
+
+    def get(self, url, **kwargs):
+        # An HTTPS-only host
+        if url.startswith("http:"):
+            raise requests.ConnectionError("Connection refused")
+        return FakeResponse(200, {"Strict-Transport-Security": "max-age=31536000"})
+
+    def assessment(self, hostName, deadline):
+        self.assessments.append(hostName)
+        return {"grade": "A"}
+
+    def test_failed_scheme_is_part_of_the_summary(self):
+        summary = utils.getFingerprint("example.com")
+        self.assertEqual(summary["http"], {"error": "ConnectionError"})
+        self.assertEqual(summary["https"][0], 200)
+        self.assertEqual(summary["tls"]["cert"], "AB:CD")
+
+    def test_unreachable_host_has_no_fingerprint(self):
+        patch(self, utils, "tlsHandshake", lambda hostName, deadline: 1 / 0)
+        patch(self, utils.requests, "get", lambda url, **kwargs: 1 / 0)
+        self.assertIsNone(utils.getFingerprint("example.com"))
+
+    def test_https_only_host_is_skipped(self):
+        result = {}
+        utils.assess("ssllabs", "example.com", "example.com", utils.NO_DEADLINE, result, self.assessment)
+        self.assertEqual(self.assessments, ["example.com"])
+
+        # As kept in the run history
+        self.lastResult = json.loads(json.dumps(result))
+        newResult = {}
+        assessment = utils.assess("ssllabs", "example.com", "example.com", utils.NO_DEADLINE,
+                                  newResult, self.assessment)
+        self.assertEqual(assessment, {"grade": "A"})
+        self.assertEqual(self.assessments, ["example.com"])
+        self.assertEqual(newResult["fingerprint"], result["fingerprint"])
+        self.assertEqual(newResult["assessedAt"], result["assessedAt"])
+
+
+class TrackingIssueTest(unittest.TestCase):
+    def setUp(self):
+        environ = dict(os.environ)
+        self.addCleanup(os.environ.update, environ)
+        self.addCleanup(os.environ.clear)
+        os.environ.pop("INVENTORYTAGS", None)
+        os.environ.update(ISSUEREPOPATH="owner/issues", OAUTHTOKEN="token")
+        self.issues = []
+        self.requests = []
+        patch(self, utils.requests, "get", self.get)
+        patch(self, utils.requests, "post", lambda url, **kwargs: self.record("post", url, kwargs))
+        patch(self, utils.requests, "patch", lambda url, **kwargs: self.record("patch", url, kwargs))
+
+    def get(self, url, **kwargs):
+        return FakeResponse(200, data={"items": self.issues})
+
+    def record(self, method, url, kwargs):
+        self.requests.append((method, url, kwargs["json"]))
+        return FakeResponse(200)
+
+    def tracking(self, configured=None):
+        return utils.TrackingIssue("certexpiry", ["Endpoint", "Days left"], configured)
+
+    def openIssue(self, rows):
+        tracking = self.tracking()
+        self.issues = [{"title": "Findings of certexpiry other", "number": 1, "body": ""},
+                       {"title": tracking.title, "number": 2, "body": tracking.render(rows)}]
+
+    def test_opens_issue(self):
+        tracking = self.tracking()
+        tracking.finding("a.com", ["1.2.3.4:443", 5], [])
+        tracking.flush()
+        [(method, url, data)] = self.requests
+        self.assertEqual((method, url), ("post", "https://api.github.com/repos/owner/issues/issues"))
+        self.assertEqual(data["title"], "Findings of certexpiry")
+        self.assertEqual(list(tracking.readState(data["body"])), ["a.com"])
+
+    def test_merges_rows(self):
+        self.openIssue({
+            "fixed.com": {"cells": ["1.2.3.4:443", "5"], "since": 100},
+            "unchecked.com": {"cells": ["1.2.3.5:443", "6"], "since": 200},
+            "removed.com": {"cells": ["1.2.3.6:443", "7"], "since": 300},
+            "again.com": {"cells": ["1.2.3.7:443", "8"], "since": 400},
+        })
+        tracking = self.tracking(["fixed.com", "unchecked.com", "again.com", "new.com"])
+        tracking.ok("fixed.com")
+        tracking.finding("again.com", ["1.2.3.7:443", 4], [])
+        tracking.finding("new.com", ["1.2.3.8:443", 3], [])
+        tracking.flush()
+
+        [(method, url, data)] = self.requests
+        self.assertEqual((method, url), ("patch", "https://api.github.com/repos/owner/issues/issues/2"))
+        self.assertNotIn("state", data)
+        rows = tracking.readState(data["body"])
+        self.assertEqual(sorted(rows), ["again.com", "new.com", "unchecked.com"])
+        # Findings that are still there keep when they were first found.
+        self.assertEqual(rows["again.com"], {"cells": ["1.2.3.7:443", "4"], "since": 400})
+        self.assertEqual(rows["unchecked.com"], {"cells": ["1.2.3.5:443", "6"], "since": 200})
+        self.assertIn("| again.com | 1.2.3.7:443 | 4 | 1970-01-01 |", data["body"])
+
+    def test_closes_issue_without_findings(self):
+        self.openIssue({"fixed.com": {"cells": ["1.2.3.4:443", "5"], "since": 100}})
+        tracking = self.tracking()
+        tracking.ok("fixed.com")
+        tracking.flush()
+        [(method, url, data)] = self.requests
+        self.assertEqual((method, data["state"]), ("patch", "closed"))
+        self.assertEqual(tracking.readState(data["body"]), {})
+
+    def test_unchanged_issue_is_left_alone(self):
+        self.openIssue({"a.com": {"cells": ["1.2.3.4:443", "5"], "since": 100}})
+        tracking = self.tracking()
+        tracking.finding("a.com", ["1.2.3.4:443", 5], [])
+        tracking.flush()
+        self.assertEqual(self.requests, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
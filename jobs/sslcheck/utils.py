@@ -1,7 +1,39 @@
 #!/usr/bin/env python
 
+from __future__ import absolute_import
+
+import json
+from os import environ as env
+import re
+import socket
+import struct
+import threading
+import time
+
+from OpenSSL import SSL
 import requests
 
+from deadlines import DeadlineExceeded, NO_DEADLINE
+from history import RunHistory
+
+# Longest to wait on any single HTTP request (in seconds)
+HTTPTIMEOUT = 60
+# Longest to wait on any single network operation (in seconds)
+SOCKETTIMEOUT = 30
+# Response headers that the external assessments look at
+KEYHEADERS = [
+    "Content-Security-Policy",
+    "Location",
+    "Public-Key-Pins",
+    "Referrer-Policy",
+    "Strict-Transport-Security",
+    "X-Content-Type-Options",
+    "X-Frame-Options",
+    "X-XSS-Protection",
+]
+# Reassess hosts at least this often (in days) even if nothing changed
+ASSESSMENTMAXAGE = 30
+
 
 def createIssue(repoPath, token, title, body):
     """Create GitHub issue if one with the same title doesn't exist."""
@@ -15,7 +47,8 @@ def createIssue(repoPath, token, title, body):
                                   title},
                      headers={"Authorization": "token " + token,
                               "Accept": "application/vnd.github.v3+json",
-                              })
+                              },
+                     timeout=HTTPTIMEOUT)
     # Create new issue if not duplicate
     if r.json()["total_count"] == 0:
         # Reference: https://developer.github.com/v3/issues/#create-an-issue
@@ -23,4 +56,296 @@ def createIssue(repoPath, token, title, body):
                       headers={"Authorization": "token " + token,
                                "Accept": "application/vnd.github.v3+json",
                                "Content-Type": "application/json"},
-                      json={"title": title, "body": body})
+                      json={"title": title, "body": body},
+                      timeout=HTTPTIMEOUT)
+
+
+def githubHeaders(token):
+    return {"Authorization": "token " + token,
+            "Accept": "application/vnd.github.v3+json"}
+
+
+def escapeCell(cell):
+    """Make text safe to put in a Markdown table cell."""
+    return str(cell).replace("|", "\\|").replace("\n", " ")
+
+
+class IssueAlerts(object):
+    """Report findings as a GitHub issue each (the default)."""
+
+    def ok(self, target):
+        pass
+
+    def finding(self, target, cells, issues):
+        """Report a finding about target.
+
+        issues is a list of (title, body) of the issues to create.
+        """
+        for title, body in issues:
+            createIssue(env["ISSUEREPOPATH"], env["OAUTHTOKEN"], title, body)
+
+    def flush(self):
+        pass
+
+
+class TrackingIssue(object):
+    """Report all of a job's findings in a single tracking issue.
+
+    The issue has a table of the current findings, one row per target, and
+    keeps the rows as JSON in an HTML comment so the next run can update
+    them. Targets that were checked and are fine lose their row, and those
+    that weren't checked in this run keep theirs. All changes are made in one
+    edit at the end of the run, and the issue is closed once there are no
+    findings left.
+    """
+
+    STATEMARKER = "strongjobs-state"
+
+    def __init__(self, job, columns, configured=None):
+        self.title = "Findings of " + job
+        # One issue per group of targets
+        if env.get("INVENTORYTAGS"):
+            self.title += " tagged " + env["INVENTORYTAGS"]
+        self.columns = columns
+        self.configured = configured
+        self.resolved = set()
+        self.found = {}
+
+    def ok(self, target):
+        self.resolved.add(target)
+        self.found.pop(target, None)
+
+    def finding(self, target, cells, issues):
+        self.resolved.discard(target)
+        self.found[target] = [str(cell) for cell in cells]
+
+    def findIssue(self):
+        """Get the open tracking issue, if there is one."""
+        # Reference: https://developer.github.com/v3/search/#search-issues
+        r = requests.get("https://api.github.com/search/issues",
+                         params={"q": "repo:%s in:title is:open type:issue %s" %
+                                      (env["ISSUEREPOPATH"], self.title)},
+                         headers=githubHeaders(env["OAUTHTOKEN"]),
+                         timeout=HTTPTIMEOUT)
+        r.raise_for_status()
+        for issue in r.json()["items"]:
+            # The search also matches titles that just contain ours
+            if issue["title"] == self.title:
+                return issue
+        return None
+
+    def readState(self, body):
+        start = (body or "").find("<!-- %s " % self.STATEMARKER)
+        if start == -1:
+            return {}
+        start += len("<!-- %s " % self.STATEMARKER)
+        return json.loads(body[start:body.index(" -->", start)])
+
+    def render(self, rows):
+        lines = ["| Target | %s | Since |" % " | ".join(self.columns),
+                 "| --- |" + " --- |" * (len(self.columns) + 1)]
+        for target in sorted(rows):
+            row = rows[target]
+            since = time.strftime("%Y-%m-%d", time.gmtime(row["since"]))
+            lines.append("| " + " | ".join(escapeCell(cell) for cell in [target] + row["cells"] + [since]) + " |")
+        # "--" would end the comment early, so escape it within the JSON
+        state = json.dumps(rows, sort_keys=True).replace("--", "-\\u002d")
+        return ("%d finding(s), updated %s.\n\n%s\n\n<!-- %s %s -->" %
+                (len(rows), time.strftime("%Y-%m-%d %H:%M UTC", time.gmtime()),
+                 "\n".join(lines), self.STATEMARKER, state))
+
+    def flush(self):
+        """Bring the tracking issue up to date with what this run found."""
+        issue = self.findIssue()
+        previous = self.readState(issue["body"]) if issue else {}
+
+        rows = {}
+        for target, row in previous.items():
+            if target in self.resolved:
+                continue
+            if self.configured is not None and target not in self.configured:
+                continue
+            rows[target] = row
+        now = time.time()
+        for target, cells in self.found.items():
+            rows[target] = {"cells": cells, "since": rows.get(target, {}).get("since", now)}
+
+        if rows == previous:
+            print("No changes to the %s issue" % self.title)
+            return
+        if issue is None:
+            print("Opening the %s issue" % self.title)
+            # Reference: https://developer.github.com/v3/issues/#create-an-issue
+            r = requests.post("https://api.github.com/repos/%s/issues" % env["ISSUEREPOPATH"],
+                              headers=githubHeaders(env["OAUTHTOKEN"]),
+                              json={"title": self.title, "body": self.render(rows)},
+                              timeout=HTTPTIMEOUT)
+        else:
+            update = {"body": self.render(rows)}
+            if not rows:
+                print("Closing the %s issue, there are no findings left" % self.title)
+                update["state"] = "closed"
+            else:
+                print("Updating the %s issue" % self.title)
+            # Reference: https://developer.github.com/v3/issues/#edit-an-issue
+            r = requests.patch("https://api.github.com/repos/%s/issues/%d" %
+                               (env["ISSUEREPOPATH"], issue["number"]),
+                               headers=githubHeaders(env["OAUTHTOKEN"]),
+                               json=update,
+                               timeout=HTTPTIMEOUT)
+        r.raise_for_status()
+
+
+def alertSink(job, columns, configured=None):
+    """Where a job reports findings, depending on ALERTMODE.
+
+    ALERTMODE=tracking keeps one TrackingIssue per job (and INVENTORYTAGS),
+    with the given table columns. Rows of targets not in configured are
+    dropped. Otherwise each finding gets its own issue.
+    """
+    if env.get("ALERTMODE", "issues") == "tracking":
+        return TrackingIssue(job, columns, configured)
+    return IssueAlerts()
+
+
+def setSocketTimeout(sock, seconds):
+    """Time out blocking reads and writes on a socket.
+
+    pyOpenSSL doesn't support Python's socket timeouts, so have the kernel
+    time them out instead.
+    """
+    timeval = struct.pack('ll', int(seconds), int(seconds % 1 * 1000000))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeval)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeval)
+
+
+def tlsHandshake(hostName, deadline=NO_DEADLINE, port=443, address=None):
+    """Do a TLS handshake with a host and return what was negotiated.
+
+    address, if given, is the IP address to connect to instead of resolving
+    hostName (which is still used for SNI).
+    """
+    # Initialize openssl context, allowing anything from TLS 1.0 up
+    ctx = SSL.Context(SSL.SSLv23_METHOD)
+    ctx.set_options(SSL.OP_NO_SSLv2 | SSL.OP_NO_SSLv3)
+    # Connect to server
+    sock = socket.create_connection((address or hostName, port), deadline.timeout(SOCKETTIMEOUT))
+    sock.settimeout(None)
+    setSocketTimeout(sock, deadline.timeout(SOCKETTIMEOUT))
+    sslSock = SSL.Connection(ctx, sock)
+    sslSock.set_tlsext_host_name(hostName.encode("idna"))
+    sslSock.set_connect_state()
+    # Extract the certificate from openssl
+    sslSock.do_handshake()
+    info = {
+        "cert": sslSock.get_peer_certificate(),
+        "chain": sslSock.get_peer_cert_chain(),
+        "protocol": sslSock.get_protocol_version_name(),
+        "cipher": sslSock.get_cipher_name(),
+    }
+    # Clean up
+    sslSock.shutdown()
+    sock.close()
+    return info
+
+
+class DnsCache(object):
+    """Resolve each host name once per run, safe to share between threads."""
+
+    def __init__(self):
+        self.addresses = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, hostName):
+        """Return every A and AAAA address of a host."""
+        with self.lock:
+            if hostName in self.addresses:
+                return self.addresses[hostName]
+        infos = socket.getaddrinfo(hostName, None, 0, socket.SOCK_STREAM)
+        addresses = sorted(set(info[4][0] for info in infos))
+        with self.lock:
+            self.addresses[hostName] = addresses
+        return addresses
+
+
+def normalizeHeader(header, value):
+    """Leave out the parts of a header that change on every request."""
+    if value is None:
+        return None
+    if header == "Content-Security-Policy":
+        return re.sub(r"'nonce-[^']*'", "'nonce'", value)
+    if header == "Location":
+        # Query strings and fragments may hold session IDs
+        return re.split(r"[?#]", value, 1)[0]
+    return value
+
+
+def getFingerprint(hostName, deadline=NO_DEADLINE):
+    """Cheaply summarize what an external assessment of a host would see.
+
+    Covers the certificate, the negotiated protocol and cipher, and the key
+    headers of the HTTPS and HTTP front pages. Parts that fail (e.g. a host
+    without HTTP) are summarized by the type of error, so such hosts can still
+    be recognized as unchanged. Returns None if every part failed.
+    """
+    def failure(e):
+        # Errors caused by running out of time don't describe the host.
+        deadline.check()
+        return {"error": type(e).__name__}
+
+    summary = {}
+    try:
+        handshake = tlsHandshake(hostName, deadline)
+        summary["tls"] = {
+            "cert": handshake["cert"].digest("sha256").decode("ascii"),
+            "protocol": handshake["protocol"],
+            "cipher": handshake["cipher"],
+        }
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        summary["tls"] = failure(e)
+    for scheme in ("https", "http"):
+        try:
+            res = requests.get("%s://%s/" % (scheme, hostName), allow_redirects=False,
+                               timeout=deadline.timeout(HTTPTIMEOUT))
+            summary[scheme] = [res.status_code] + [normalizeHeader(header, res.headers.get(header))
+                                                   for header in KEYHEADERS]
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            summary[scheme] = failure(e)
+    if all(isinstance(part, dict) and "error" in part for part in summary.values()):
+        return None
+    return summary
+
+
+def assess(job, target, hostName, deadline, result, assessment):
+    """Run a full external assessment of a host only if it is needed.
+
+    The last assessment of target is reused if the host's fingerprint hasn't
+    changed since and it is younger than ASSESSMENTMAXAGE days (set
+    ASSESSMENTMAXAGE in the environment to override). Otherwise
+    assessment(hostName, deadline) is called. Either way its value is
+    returned and kept in result for next time.
+
+    If the host can't be fingerprinted at all (e.g. it doesn't resolve), it
+    is always assessed.
+    """
+    fingerprint = getFingerprint(hostName, deadline)
+    if fingerprint is None:
+        print("Couldn't fingerprint %s, assessing it anyway" % hostName)
+    result["fingerprint"] = fingerprint
+
+    maxAge = float(env.get("ASSESSMENTMAXAGE", ASSESSMENTMAXAGE)) * 24 * 60 * 60
+    last = RunHistory().last_success(job, target)
+    previous = last["result"] if last else None
+    if (fingerprint and previous and previous.get("fingerprint") == fingerprint and
+            "assessment" in previous and time.time() - previous["assessedAt"] < maxAge):
+        print("%s hasn't changed since it was last assessed, reusing that" % hostName)
+        result["assessedAt"] = previous["assessedAt"]
+        result["assessment"] = previous["assessment"]
+    else:
+        result["assessedAt"] = time.time()
+        result["assessment"] = assessment(hostName, deadline)
+    return result["assessment"]
@@ -0,0 +1,170 @@
+import errno
+import fcntl
+import json
+import os
+from os import path
+import shutil
+import time
+
+
+# Directories of build artifacts that can be thrown away and rebuilt.
+ARTIFACTS = ['node_modules']
+
+# Don't evict anything used this recently (in seconds), it may be in use by the
+# other dependency job.
+PROTECT_FOR = 60 * 60
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(size):
+    """Parse a size like "500M" or "4G" into bytes."""
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in UNITS:
+        return int(float(size[:-1]) * UNITS[size[-1]])
+    return int(size)
+
+
+def disk_usage(directory):
+    """Bytes used by the files under directory."""
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.lstat(path.join(root, name)).st_size
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+    return total
+
+
+class RepoCache(object):
+    """
+    Keep the clones under root_path within a disk budget.
+
+    The last time each repo was used is tracked in an index file. When the
+    checkouts are over budget, build artifacts are removed first, then whole
+    checkouts, least recently used first. Repos that are no longer configured
+    are removed regardless of the budget. Anything else under root_path (such
+    as the shared object store) doesn't count towards the budget.
+    """
+
+    INDEX = '.cache-index.json'
+
+    def __init__(self, root_path, budget):
+        self.root_path = root_path
+        self.budget = budget
+        self.index_path = path.join(root_path, self.INDEX)
+
+    def _update_index(self, update):
+        """Read, change and write the index under a lock."""
+        with open(self.index_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = {}
+                if path.exists(self.index_path):
+                    with open(self.index_path, 'r') as f:
+                        index = json.load(f)
+                update(index)
+                tmp_path = self.index_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(index, f, indent=2, sort_keys=True)
+                os.rename(tmp_path, self.index_path)
+                return index
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def use(self, repo_path):
+        """Record that a repo is being used."""
+        self._update_index(lambda index: index.update({repo_path: time.time()}))
+
+    def in_use(self):
+        """Repo paths that were used too recently to be evicted."""
+        index = self._update_index(lambda index: None)
+        now = time.time()
+        return [repo_path for repo_path, last_used in index.items() if now - last_used <= PROTECT_FOR]
+
+    def repos(self):
+        """Every cloned repo path (owner/name) on disk."""
+        found = []
+        for owner in os.listdir(self.root_path):
+            owner_path = path.join(self.root_path, owner)
+            if owner.startswith('.') or not path.isdir(owner_path):
+                continue
+            for name in os.listdir(owner_path):
+                if path.isdir(path.join(owner_path, name, '.git')):
+                    found.append(owner + '/' + name)
+        return found
+
+    def _remove(self, repo_path, artifacts=None):
+        """
+        Remove a repo, or just its artifacts, unless it was used since evict()
+        looked. Returns whether it was removed.
+        """
+        removed = []
+
+        def remove(index):
+            # Checked under the index lock, so the other job can't start using
+            # the repo while it's being removed.
+            if time.time() - index.get(repo_path, 0) <= PROTECT_FOR:
+                print("Not evicting %s from the repo cache, it was just used" % repo_path)
+                return
+            if artifacts is None:
+                print("Evicting %s from the repo cache" % repo_path)
+                shutil.rmtree(path.join(self.root_path, repo_path))
+                index.pop(repo_path, None)
+            else:
+                for artifact in artifacts:
+                    print("Removing %s from the repo cache" % artifact)
+                    shutil.rmtree(artifact)
+            removed.append(repo_path)
+
+        self._update_index(remove)
+        return bool(removed)
+
+    def _artifacts(self, repo_path):
+        """Build artifact directories in a repo."""
+        found = []
+        for root, dirs, files in os.walk(path.join(self.root_path, repo_path)):
+            if '.git' in dirs:
+                dirs.remove('.git')
+            for name in ARTIFACTS:
+                if name in dirs:
+                    dirs.remove(name)
+                    found.append(path.join(root, name))
+        return found
+
+    def evict(self, configured):
+        """Remove unconfigured repos, then evict until within budget."""
+        index = self._update_index(lambda index: None)
+        now = time.time()
+
+        def last_used(repo_path):
+            return index.get(repo_path, 0)
+
+        # Only consider repos that aren't (possibly) in use, oldest first.
+        candidates = sorted([r for r in self.repos() if now - last_used(r) > PROTECT_FOR], key=last_used)
+
+        for repo_path in candidates:
+            if repo_path not in configured:
+                self._remove(repo_path)
+        candidates = [r for r in candidates if r in configured]
+
+        total = sum(disk_usage(path.join(self.root_path, r)) for r in self.repos())
+        for repo_path in candidates:
+            if total <= self.budget:
+                return
+            artifacts = self._artifacts(repo_path)
+            size = sum(disk_usage(artifact) for artifact in artifacts)
+            if artifacts and self._remove(repo_path, artifacts):
+                total -= size
+
+        for repo_path in candidates:
+            if total <= self.budget:
+                return
+            size = disk_usage(path.join(self.root_path, repo_path))
+            if self._remove(repo_path):
+                total -= size
+
+        if total > self.budget:
+            print("Repo cache is still %d bytes over budget" % (total - self.budget))
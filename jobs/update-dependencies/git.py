@@ -1,34 +1,62 @@
+import fcntl
 from os import path
-from subprocess import PIPE, Popen
+
+from deadlines import NO_DEADLINE, run_command
+
+
+def github_url(repo_path):
+    return 'ssh://git@github.com/' + repo_path
 
 
 class GitRepo(object):
     class RunError(RuntimeError):
         pass
 
-    def __init__(self, root_path, repo_path):
+    def __init__(self, root_path, repo_path, shared=None, deadline=NO_DEADLINE):
         self.path = repo_path
         self.directory = path.join(root_path, self.path)
+        self.shared = shared
+        # Every git command has to finish by this deadline.
+        self.deadline = deadline
+        # Whether the shared store has this repo's latest objects, so they are
+        # only fetched into it once.
+        self.fetched = False
 
         # Clone the repo if it isn't there.
         if not path.exists(self.directory):
-            proc = Popen(['git', 'clone', 'ssh://git@github.com/' + self.path, self.directory], stdout=PIPE, stderr=PIPE)
-            proc.wait()
-            if proc.returncode is not 0:
-                raise GitRepo.RunError(proc.stderr.read())
+            args = ['git', 'clone']
+            if self.shared:
+                # Get the objects into the shared store first so the clone
+                # only needs to transfer what is missing.
+                self.fetch_shared()
+                args += ['--reference', self.shared.directory]
+            GitRepo.execute(args + [github_url(self.path), self.directory], deadline=self.deadline)
+        elif self.shared:
+            self.shared.borrow(self.directory)
+
+    @staticmethod
+    def execute(args, cwd=None, deadline=NO_DEADLINE):
+        returncode, stdout, stderr = run_command(args, cwd, deadline)
+        if returncode != 0:
+            raise GitRepo.RunError(stderr)
+
+        return stdout
 
     def run(self, *args):
         args = ('git', '--git-dir=' + path.join(self.directory, '.git'), '--work-tree=' + self.directory) + args
-        proc = Popen(args, cwd=self.directory, stdout=PIPE, stderr=PIPE)
-        proc.wait()
-        if proc.returncode is not 0:
-            raise GitRepo.RunError(proc.stderr.read())
+        return GitRepo.execute(args, cwd=self.directory, deadline=self.deadline)
+
+    def fetch_shared(self):
+        """Fetch the repo into the shared store, once."""
+        if self.shared and not self.fetched:
+            self.shared.fetch(self.path, self.deadline)
+            self.fetched = True
 
-        return proc.stdout.read()
+    def update(self, branch='master'):
+        self.fetch_shared()
 
-    def update(self):
         self.run('reset', '--hard')
-        self.run('checkout', 'master')
+        self.run('checkout', branch)
         self.run('pull')
 
         # Clean-up upstream branches.
@@ -36,6 +64,117 @@ class GitRepo(object):
 
         # Delete all local branches (to get a pristine state).
         branches = self.run('branch')
-        branches = [branch[2:] for branch in branches.split('\n') if branch and branch[2:] != 'master']
+        branches = [name[2:] for name in branches.split('\n') if name and name[2:] != branch]
         if branches:
             self.run('branch', '-D', *branches)
+
+    def maintain(self):
+        """Incremental maintenance to keep fetches fast."""
+        try:
+            self.run('maintenance', 'run', '--task=commit-graph', '--task=loose-objects', '--task=incremental-repack')
+        except GitRepo.RunError:
+            # git maintenance needs git 2.30, so fall back to what older
+            # versions have.
+            self.run('gc', '--auto', '--quiet')
+
+
+class SharedObjectStore(object):
+    """
+    A bare repository holding the objects of every cloned repo.
+
+    Clones borrow objects from it through git alternates, so forks and related
+    repos share their common history on disk, and fetching a new related repo
+    only transfers the objects the store doesn't already have.
+
+    Clones can't know which of their objects only exist in the store, so the
+    store must never lose an object a clone uses. Automatic gc is turned off in
+    favour of maintain(), which only prunes objects that neither the store's
+    refs nor the refs of the clones it is given lead to.
+    """
+
+    # Repack once there are this many loose objects or packs.
+    MAX_LOOSE_OBJECTS = 5000
+    MAX_PACKS = 20
+
+    def __init__(self, directory):
+        self.directory = directory
+        # Whether repos were dropped since the last prune.
+        self.forgotten = False
+
+        if not path.exists(self.directory):
+            GitRepo.execute(['git', 'init', '--bare', self.directory])
+            self.run('config', 'gc.auto', '0')
+            self.run('config', 'gc.pruneExpire', 'never')
+            self.run('config', 'gc.reflogExpireUnreachable', 'never')
+
+    def run(self, *args, **kwargs):
+        # Both dependency jobs may be using the store at the same time.
+        with open(self.directory + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return GitRepo.execute(('git', '--git-dir=' + self.directory) + args, **kwargs)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def fetch(self, repo_path, deadline=NO_DEADLINE):
+        """Fetch a repo's branches into the store."""
+        # Refs of deleted branches are kept (no --prune), so objects that
+        # clones may still use stay reachable.
+        self.run('fetch', '--quiet', '--no-tags', github_url(repo_path),
+                 '+refs/heads/*:refs/remotes/%s/*' % repo_path, deadline=deadline)
+
+    def _refs(self, *prefixes):
+        return self.run('for-each-ref', '--format=%(refname)', *prefixes).splitlines()
+
+    def repos(self):
+        """Paths (owner/name) of the repos the store has refs of."""
+        return set('/'.join(ref.split('/')[2:4]) for ref in self._refs('refs/remotes/', 'refs/clones/'))
+
+    def forget(self, repo_path):
+        """Drop a repo's refs, so maintain() can prune what only it used."""
+        print("Dropping %s from the shared object store" % repo_path)
+        for ref in self._refs('refs/remotes/%s/' % repo_path, 'refs/clones/%s/' % repo_path):
+            self.run('update-ref', '-d', ref)
+        self.forgotten = True
+
+    def borrow(self, repo_directory):
+        """Make an existing clone use the store's objects."""
+        objects = path.join(self.directory, 'objects')
+        alternates = path.join(repo_directory, '.git', 'objects', 'info', 'alternates')
+        if path.exists(alternates):
+            with open(alternates, 'r') as f:
+                if objects in f.read().splitlines():
+                    return
+        with open(alternates, 'a') as f:
+            f.write(objects + '\n')
+
+    def maintain(self, clones):
+        """
+        Repack the store if needed, pruning the objects of forgotten repos.
+
+        clones is a dict of repo path to directory of every clone using the
+        store.
+        """
+        if self.forgotten:
+            # Keep everything the clones point at, including their own
+            # commits and branches since deleted or rewritten upstream. Their
+            # reflogs may point at anything, so they go.
+            for repo_path, directory in sorted(clones.items()):
+                git_dir = path.join(directory, '.git')
+                GitRepo.execute(['git', '--git-dir=' + git_dir, 'reflog', 'expire', '--expire=all', '--all'])
+                self.run('fetch', '--quiet', '--no-tags', '--prune', git_dir,
+                         '+refs/heads/*:refs/clones/%s/heads/*' % repo_path,
+                         '+refs/remotes/*:refs/clones/%s/remotes/*' % repo_path)
+            self.run('repack', '-a', '-d', '--quiet')
+            self.run('prune', '--expire=now')
+            self.run('pack-refs', '--all')
+            self.forgotten = False
+            return
+
+        stats = dict(line.split(': ', 1) for line in self.run('count-objects', '-v').splitlines())
+        if int(stats['count']) < self.MAX_LOOSE_OBJECTS and int(stats['packs']) < self.MAX_PACKS:
+            return
+        # -k keeps unreachable objects in the new pack instead of dropping
+        # them, as clones may still need them.
+        self.run('repack', '-a', '-d', '-k', '--quiet')
+        self.run('pack-refs', '--all')
@@ -3,7 +3,85 @@ import json
 import requests
 
 
-def create_pull_request(repo_path, token, title, branch_name):
+GRAPHQL_URL = "https://api.github.com/graphql"
+
+# Longest to wait on any single HTTP request (in seconds)
+HTTP_TIMEOUT = 60
+
+# Repos to look up per GraphQL request.
+BATCH_SIZE = 25
+
+# Only the most recently updated pull requests are looked at, which covers the
+# update branches that matter.
+REPO_QUERY = """
+  r%(index)d: repository(owner: %(owner)s, name: %(name)s) {
+    defaultBranchRef { name }
+    pullRequests(first: 100, orderBy: {field: UPDATED_AT, direction: DESC}) {
+      nodes { headRefName state }
+    }
+  }
+"""
+
+
+def get_repo_states(repo_paths, token):
+    """
+    Look up the default branch and pull requests of many repos in a few
+    batched GraphQL requests.
+
+    Returns a dict of repo path to {"default_branch": name, "pull_requests":
+    {head branch name: "OPEN" / "CLOSED" / "MERGED"}}. Repos that couldn't be
+    found or looked up are left out, so they are updated without knowing
+    their state.
+    """
+    states = {}
+    for start in range(0, len(repo_paths), BATCH_SIZE):
+        batch = repo_paths[start:start + BATCH_SIZE]
+        query = "query {%s}" % "".join(REPO_QUERY % {
+            "index": index,
+            "owner": json.dumps(repo_path.split('/')[0]),
+            "name": json.dumps(repo_path.split('/')[1]),
+        } for index, repo_path in enumerate(batch))
+
+        # Reference: https://developer.github.com/v4/
+        try:
+            r = requests.post(
+                GRAPHQL_URL,
+                data=json.dumps({"query": query}),
+                headers={
+                    "Authorization": "bearer " + token,
+                    "Content-Type": "application/json"
+                },
+                timeout=HTTP_TIMEOUT
+            )
+            if r.status_code != 200:
+                raise RuntimeError("HTTP %d: %s" % (r.status_code, r.text))
+            result = r.json()
+        except (requests.RequestException, RuntimeError, ValueError) as e:
+            print("Unable to look up repos %s: %s" % (", ".join(batch), e))
+            continue
+
+        # Missing repos come back as null with an error, but don't fail the
+        # rest of the batch.
+        for error in result.get("errors", []):
+            print("GitHub GraphQL error: %s" % error.get("message"))
+        data = result.get("data") or {}
+        for index, repo_path in enumerate(batch):
+            repo = data.get("r%d" % index)
+            if repo is None:
+                continue
+            pull_requests = {}
+            # The newest pull request for a branch wins.
+            for pull_request in reversed(repo["pullRequests"]["nodes"]):
+                pull_requests[pull_request["headRefName"]] = pull_request["state"]
+            states[repo_path] = {
+                "default_branch": (repo["defaultBranchRef"] or {}).get("name", "master"),
+                "pull_requests": pull_requests,
+            }
+
+    return states
+
+
+def create_pull_request(repo_path, token, title, branch_name, base="master"):
     """Create a Pull Request."""
     # Reference: https://developer.github.com/v3/pulls/
     r = requests.post(
@@ -12,13 +90,14 @@ def create_pull_request(repo_path, token, title, branch_name):
             "title": title,
             "body": "auto-generated",
             "head": branch_name,
-            "base": "master"
+            "base": base
         }),
         headers={
             "Authorization": "token " + token,
             "Accept": "application/vnd.github.v3+json",
             "Content-Type": "application/json"
-        }
+        },
+        timeout=HTTP_TIMEOUT
     )
 
     if r.status_code != 201:
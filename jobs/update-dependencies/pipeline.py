@@ -0,0 +1,72 @@
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+
+# Marks the end of the items in a queue.
+_DONE = object()
+
+
+def run_pipeline(items, stages, maxsize=2):
+    """
+    Pass each item through a sequence of stages which run at the same time.
+
+    The first stage runs in the calling thread and each later stage in its own
+    thread, connected by queues holding at most maxsize items, so e.g. network
+    waits for one item overlap with local work on the next. Each stage gets
+    what the previous stage returned; returning None drops the item. Items go
+    through every stage in the order they were given.
+
+    Returns a list of (item, exception) for the items where a stage raised,
+    in the order of the items. Later stages are skipped for those items.
+    """
+    errors = []
+    errors_lock = threading.Lock()
+
+    def fail(index, item, e):
+        with errors_lock:
+            errors.append((index, item, e))
+
+    def worker(stage, inbox, outbox):
+        while True:
+            entry = inbox.get()
+            if entry is _DONE:
+                if outbox is not None:
+                    outbox.put(_DONE)
+                return
+            index, item, value = entry
+            try:
+                value = stage(value)
+            except Exception as e:
+                fail(index, item, e)
+                continue
+            if value is not None and outbox is not None:
+                outbox.put((index, item, value))
+
+    queues = [Queue(maxsize) for stage in stages[1:]]
+    threads = []
+    for i, stage in enumerate(stages[1:]):
+        outbox = queues[i + 1] if i + 1 < len(queues) else None
+        thread = threading.Thread(target=worker, args=(stage, queues[i], outbox))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    for index, item in enumerate(items):
+        try:
+            value = stages[0](item)
+        except Exception as e:
+            fail(index, item, e)
+            continue
+        if value is not None and queues:
+            queues[0].put((index, item, value))
+
+    if queues:
+        queues[0].put(_DONE)
+    for thread in threads:
+        thread.join()
+
+    return [(item, e) for index, item, e in sorted(errors, key=lambda error: error[0])]
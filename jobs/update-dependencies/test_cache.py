@@ -0,0 +1,60 @@
+import json
+import os
+from os import path
+import shutil
+import tempfile
+import time
+import unittest
+
+import cache
+from cache import RepoCache
+
+
+class RepoCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.root_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root_path)
+        # Two repos last used a day ago.
+        index = {}
+        for repo_path in ['owner/a', 'owner/b']:
+            os.makedirs(path.join(self.root_path, repo_path, '.git'))
+            with open(path.join(self.root_path, repo_path, 'data'), 'w') as f:
+                f.write('x' * 1000)
+            index[repo_path] = time.time() - 24 * 60 * 60
+        with open(path.join(self.root_path, RepoCache.INDEX), 'w') as f:
+            json.dump(index, f)
+
+    def test_evict_unconfigured(self):
+        RepoCache(self.root_path, 10 ** 6).evict(['owner/a'])
+        self.assertEqual(RepoCache(self.root_path, 0).repos(), ['owner/a'])
+
+    def test_evict_over_budget(self):
+        RepoCache(self.root_path, 1500).evict(['owner/a', 'owner/b'])
+        self.assertEqual(len(RepoCache(self.root_path, 0).repos()), 1)
+
+    def test_other_files_dont_count(self):
+        # Like the shared object store and the run history
+        os.makedirs(path.join(self.root_path, '.objects.git'))
+        with open(path.join(self.root_path, '.objects.git', 'pack'), 'w') as f:
+            f.write('x' * 10000)
+        RepoCache(self.root_path, 2500).evict(['owner/a', 'owner/b'])
+        self.assertEqual(len(RepoCache(self.root_path, 0).repos()), 2)
+
+    def test_repo_used_while_evicting_is_kept(self):
+        repo_cache = RepoCache(self.root_path, 0)
+        disk_usage = cache.disk_usage
+
+        def use_while_measuring(directory):
+            # The other job starts using a repo after evict() decided what
+            # to remove.
+            repo_cache.use('owner/a')
+            return disk_usage(directory)
+
+        cache.disk_usage = use_while_measuring
+        self.addCleanup(setattr, cache, 'disk_usage', disk_usage)
+        repo_cache.evict(['owner/a', 'owner/b'])
+        self.assertEqual(repo_cache.repos(), ['owner/a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+from os import path
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import git
+from git import GitRepo, SharedObjectStore
+
+
+class FakeStore(object):
+    """Counts fetches instead of going to GitHub."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.fetches = []
+        subprocess.check_call(['git', 'init', '--quiet', '--bare', directory])
+
+    def fetch(self, repo_path, deadline):
+        self.fetches.append(repo_path)
+
+    def borrow(self, repo_directory):
+        pass
+
+
+def git_output(*args):
+    return subprocess.check_output(('git',) + args, universal_newlines=True).strip()
+
+
+class GitTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.root_path = path.join(self.directory, 'repos')
+
+        # Repos in a directory to stand in for GitHub.
+        github_url = git.github_url
+        git.github_url = lambda repo_path: path.join(self.directory, 'github', repo_path)
+        self.addCleanup(setattr, git, 'github_url', github_url)
+
+    def create_origin(self, repo_path, message):
+        """Create a repo on "GitHub" with one commit, returning its hash."""
+        origin = git.github_url(repo_path)
+        work = path.join(self.directory, 'work', repo_path)
+        subprocess.check_call(['git', 'init', '--quiet', '--bare', origin])
+        subprocess.check_call(['git', 'init', '--quiet', work])
+        subprocess.check_call(['git', '-C', work, '-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+                               'commit', '--quiet', '--allow-empty', '-m', message])
+        subprocess.check_call(['git', '-C', work, 'push', '--quiet', origin, 'HEAD:master'])
+        return git_output('-C', work, 'rev-parse', 'HEAD')
+
+
+class GitRepoTest(GitTestCase):
+    def setUp(self):
+        super(GitRepoTest, self).setUp()
+        self.store = FakeStore(path.join(self.directory, 'store.git'))
+        self.create_origin('owner/repo', 'Initial')
+
+    def test_new_repo_is_fetched_into_the_store_once(self):
+        GitRepo(self.root_path, 'owner/repo', self.store).update()
+        self.assertEqual(self.store.fetches, ['owner/repo'])
+
+    def test_cloned_repo_is_fetched_into_the_store_once(self):
+        GitRepo(self.root_path, 'owner/repo', self.store)
+        self.store.fetches = []
+        GitRepo(self.root_path, 'owner/repo', self.store).update()
+        self.assertEqual(self.store.fetches, ['owner/repo'])
+
+
+class SharedObjectStoreTest(GitTestCase):
+    def setUp(self):
+        super(SharedObjectStoreTest, self).setUp()
+        self.store = SharedObjectStore(path.join(self.directory, 'store.git'))
+        self.commits = {}
+        for repo_path in ['owner/a', 'owner/b']:
+            self.commits[repo_path] = self.create_origin(repo_path, repo_path)
+            GitRepo(self.root_path, repo_path, self.store).update()
+
+    def has_object(self, commit):
+        return subprocess.call(['git', '--git-dir=' + self.store.directory, 'cat-file', '-e', commit]) == 0
+
+    def test_forgotten_repo_is_pruned(self):
+        shutil.rmtree(path.join(self.root_path, 'owner/b'))
+        self.store.forget('owner/b')
+        self.assertEqual(self.store.repos(), set(['owner/a']))
+        self.store.maintain({'owner/a': path.join(self.root_path, 'owner/a')})
+
+        self.assertFalse(self.has_object(self.commits['owner/b']))
+        self.assertTrue(self.has_object(self.commits['owner/a']))
+        # The remaining clone still has everything it needs.
+        subprocess.check_call(['git', '-C', path.join(self.root_path, 'owner/a'), 'fsck', '--no-dangling'],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def test_maintain_keeps_objects_otherwise(self):
+        self.store.maintain({})
+        self.assertTrue(self.has_object(self.commits['owner/b']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import threading
+import time
+import unittest
+
+from pipeline import run_pipeline
+
+
+class RunPipelineTest(unittest.TestCase):
+    def test_order(self):
+        seen = []
+        lock = threading.Lock()
+
+        def stage(name, delay):
+            def run(value):
+                time.sleep(delay)
+                with lock:
+                    seen.append((name, value))
+                return value
+            return run
+
+        errors = run_pipeline(range(5), [stage('a', 0), stage('b', 0.01), stage('c', 0)])
+        self.assertEqual(errors, [])
+        for name in 'abc':
+            self.assertEqual([value for stage_name, value in seen if stage_name == name], list(range(5)))
+
+    def test_dropped_items_skip_later_stages(self):
+        seen = []
+        run_pipeline(range(4), [lambda n: n if n % 2 else None, seen.append])
+        self.assertEqual(seen, [1, 3])
+
+    def test_failures(self):
+        seen = []
+
+        def first(n):
+            if n == 3:
+                raise ValueError(n)
+            return n
+
+        def second(n):
+            if n == 1:
+                raise KeyError(n)
+            return n
+
+        errors = run_pipeline(range(5), [first, second, seen.append])
+        # Errors come back in the order of the items, and the other items
+        # still get through.
+        self.assertEqual([(item, type(e)) for item, e in errors], [(1, KeyError), (3, ValueError)])
+        self.assertEqual(seen, [0, 2, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
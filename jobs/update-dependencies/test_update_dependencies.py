@@ -0,0 +1,69 @@
+from os import path
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from git import GitRepo
+import update_dependencies
+
+
+def git(*args):
+    subprocess.check_call(('git',) + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+class UpdatePackagesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        # A repo to stand in for GitHub, and a clone of it.
+        self.origin = path.join(self.directory, 'origin.git')
+        work = path.join(self.directory, 'work')
+        git('init', '--bare', self.origin)
+        git('clone', self.origin, work)
+        self.configure(work)
+        with open(path.join(work, 'requirements.txt'), 'w') as f:
+            f.write('bar==1.0\nfoo==1.0\n')
+        git('-C', work, 'add', 'requirements.txt')
+        git('-C', work, 'commit', '-m', 'Initial')
+        git('-C', work, 'push', 'origin', 'HEAD:master')
+
+        root_path = path.join(self.directory, 'repos')
+        git('clone', '--branch', 'master', self.origin, path.join(root_path, 'owner', 'repo'))
+        self.configure(path.join(root_path, 'owner', 'repo'))
+        self.repo = GitRepo(root_path, 'owner/repo')
+
+        self.pull_requests = []
+        create_pull_request = update_dependencies.create_pull_request
+        update_dependencies.create_pull_request = lambda *args: self.pull_requests.append(args)
+        self.addCleanup(setattr, update_dependencies, 'create_pull_request', create_pull_request)
+
+    def configure(self, directory):
+        git('-C', directory, 'config', 'user.name', 'Test')
+        git('-C', directory, 'config', 'user.email', 'test@example.com')
+
+    def origin_file(self, branch):
+        return subprocess.check_output(['git', '--git-dir=' + self.origin, 'show', branch + ':requirements.txt'],
+                                       universal_newlines=True)
+
+    def test_failed_package_doesnt_leak_into_the_next(self):
+        def updater(file_path, package, old_version, new_version):
+            with open(file_path, 'r') as f:
+                contents = f.read()
+            with open(file_path, 'w') as f:
+                f.write(contents.replace('%s==%s' % (package, old_version), '%s==%s' % (package, new_version)))
+            if package == 'bar':
+                raise ValueError("Couldn't finish updating bar")
+
+        with self.assertRaises(ValueError):
+            update_dependencies.update_packages(self.repo, 'token', ['requirements.txt'],
+                                                {'bar': ('1.0', '2.0'), 'foo': ('1.0', '2.0')}, updater)
+
+        self.assertEqual(self.origin_file('foo-1.0'), 'bar==1.0\nfoo==2.0\n')
+        self.assertEqual([args[2:4] for args in self.pull_requests], [('Update foo to 2.0', 'foo-1.0')])
+        self.assertRaises(subprocess.CalledProcessError, self.origin_file, 'bar-1.0')
+
+
+if __name__ == '__main__':
+    unittest.main()
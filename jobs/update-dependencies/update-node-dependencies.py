@@ -3,12 +3,11 @@
 from collections import OrderedDict
 from copy import deepcopy
 import json
-import os
-from os import environ as env, path
-from subprocess import check_output, PIPE, Popen
+from os import path
+from subprocess import CalledProcessError
 
-from git import GitRepo
-from update_dependencies import get_package_updates, update_packages
+from deadlines import run_command
+from update_dependencies import main
 
 
 PACKAGE_FILES = ["package.json"]
@@ -35,19 +34,19 @@ def update_package_json(req_file_path, package, old_version, new_version):
             f.write('\n')
 
 
-def npm_outdated(req_file_path):
+def npm_outdated(req_file_path, deadline):
     # Get every outdated package using npm.
     req_dir = path.dirname(req_file_path)
 
     # npm is dumb and needs the packages actually installed before checking if
     # they're out of date.
-    proc = check_output(['npm', 'install'], cwd=req_dir)
+    returncode, output, errors = run_command(['npm', 'install'], req_dir, deadline)
+    if returncode != 0:
+        raise CalledProcessError(returncode, 'npm install', output + errors)
 
     # Now actually check for outdated packages.
-    proc = Popen(['npm', 'outdated'], stdout=PIPE, stderr=PIPE, cwd=req_dir)
-    proc.wait()
     # Node seems to sometimes return code 0 even when there are updates.
-    result = proc.stdout.read()
+    returncode, result, errors = run_command(['npm', 'outdated'], req_dir, deadline)
 
     # The first line is the column titles, the last is blank.
     package_updates = {}
@@ -61,29 +60,5 @@ def npm_outdated(req_file_path):
     return package_updates
 
 
-def main():
-    # Check for environment variables
-    if "REPOS" not in env:
-        print("No repos. Export REPOS")
-        return 1
-    if "OAUTHTOKEN" not in env:
-        print("No Oauth token. Export OAUTHTOKEN")
-        return 1
-
-    # Get into the right directory or set it up if it doesn't exist.
-    root_path = path.expanduser(path.join('~', 'strongjobs-data'))
-    if not path.exists(root_path):
-        os.makedirs(root_path)
-
-    for repo_path in env["REPOS"].split():
-        repo = GitRepo(root_path, repo_path)
-
-        # Make sure everything is nice and up to date
-        repo.update()
-
-        package_updates = get_package_updates(repo, PACKAGE_FILES, npm_outdated)
-        update_packages(repo, env["OAUTHTOKEN"], PACKAGE_FILES, package_updates, update_package_json)
-
-
 if __name__ == '__main__':
-    main()
+    raise SystemExit(main('node-dependencies', PACKAGE_FILES, npm_outdated, update_package_json))
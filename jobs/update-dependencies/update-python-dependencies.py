@@ -21,13 +21,10 @@ Some notes:
 
 """
 
-import os
-from os import environ as env, path
 import re
-from subprocess import PIPE, Popen
 
-from git import GitRepo
-from update_dependencies import get_package_updates, update_packages
+from deadlines import run_command
+from update_dependencies import main
 
 
 REQUIREMENTS_FILES = [
@@ -87,16 +84,14 @@ def update_requirements(req_file_path, package, old_version, new_version):
             f.write(line)
 
 
-def piprot(req_file_path):
+def piprot(req_file_path, deadline):
     # Get every outdated package in each file using piprot, skipping the
     # last line that looks like "Your requirements are 560 days out of
     # date" (there should be an argument to disable that...)
-    proc = Popen(['piprot', '-o', req_file_path], stdout=PIPE, stderr=PIPE)
-    proc.wait()
-    if proc.returncode is 0:
+    returncode, result, errors = run_command(['piprot', '-o', req_file_path], deadline=deadline)
+    if returncode == 0:
         # piprot returns 1 if requirements are out of date.
         return {}
-    result = proc.stdout.read()
 
     updates = {}
     for line in result.split('\n'):
@@ -124,29 +119,5 @@ def piprot(req_file_path):
     return updates
 
 
-def main():
-    # Check for environment variables
-    if "REPOS" not in env:
-        print("No repos. Export REPOS")
-        return 1
-    if "OAUTHTOKEN" not in env:
-        print("No Oauth token. Export OAUTHTOKEN")
-        return 1
-
-    # Get into the right directory or set it up if it doesn't exist.
-    root_path = path.expanduser(path.join('~', 'strongjobs-data'))
-    if not path.exists(root_path):
-        os.makedirs(root_path)
-
-    for repo_path in env["REPOS"].split():
-        repo = GitRepo(root_path, repo_path)
-
-        # Make sure everything is nice and up to date
-        repo.update()
-
-        package_updates = get_package_updates(repo, REQUIREMENTS_FILES, piprot)
-        update_packages(repo, env["OAUTHTOKEN"], REQUIREMENTS_FILES, package_updates, update_requirements)
-
-
 if __name__ == '__main__':
-    main()
+    raise SystemExit(main('python-dependencies', REQUIREMENTS_FILES, piprot, update_requirements))
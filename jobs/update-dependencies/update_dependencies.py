@@ -1,16 +1,41 @@
-from os import path
+import os
+from os import environ as env, path
 
-from git import GitRepo
-from github import create_pull_request
+from cache import parse_size, RepoCache
+from deadlines import NO_DEADLINE
+from git import GitRepo, SharedObjectStore
+from github import create_pull_request, get_repo_states
+from inventory import Entry, load
+from pipeline import run_pipeline
+from runner import run_targets
 
 
-def update_package(repo, files, oauth_token, package, old_version, new_version, updater):
+# Don't update a repo again within this many seconds (runs every 6 hours)
+MAXAGE = 6 * 60 * 60 - 15 * 60
+# Default disk budget for the cloned repos
+CACHEBUDGET = "4G"
+
+
+def prepare_package(repo, files, package, old_version, new_version, updater, base='master', pull_requests=None):
     """
-    Update an individual package across all files.
+    Commit the update of an individual package across all files to its own
+    branch.
+
+    pull_requests is a dict of head branch name to pull request state for the
+    repo, if known. Returns what push_package() and open_pull_request() need,
+    or None if there is nothing to push.
     """
     # We use the old version so we can get multiple updates in the same branch.
     branch_name = '-'.join([package, old_version])
 
+    pull_request_state = pull_requests.get(branch_name) if pull_requests is not None else None
+    if pull_request_state == 'CLOSED':
+        print(">> Skipping %s %s, its pull request was declined" % (package, old_version))
+        return None
+    if pull_request_state == 'MERGED':
+        print(">> Skipping %s %s, its pull request was already merged" % (package, old_version))
+        return None
+
     print(">> Updating %s from %s to %s" % (package, old_version, new_version))
 
     # Create or checkout this branch.
@@ -21,7 +46,7 @@ def update_package(repo, files, oauth_token, package, old_version, new_version,
     except GitRepo.RunError:
         # Otherwise, create a new branch.
         new_branch = True
-        repo.run('checkout', '-b', branch_name, 'origin/master')
+        repo.run('checkout', '-b', branch_name, 'origin/' + base)
 
     # Rewrite each requirements file with the upgrade done.
     for req_file in files:
@@ -39,39 +64,83 @@ def update_package(repo, files, oauth_token, package, old_version, new_version,
     result = repo.run('status', '--porcelain', '--untracked-files=no')
     if not result:
         # Note that this will leave a branch with no changes on it.
-        return
+        return None
 
     # Commit the changes.
     repo.run('commit', '-m', 'Update %s to %s.' % (package, new_version))
 
+    # A pull request is created once per package version and isn't re-opened
+    # once it has been closed or merged, but pull requests will continue to be
+    # created for new versions. To stop creating new pull requests, add "skip"
+    # to a comment in the requirements file on the same line as the package.
+    # Only the most recent pull requests are looked up, so a branch that
+    # already existed may have an older one.
+    needs_pull_request = pull_request_state is None and new_branch
+
+    return {
+        "branch": branch_name,
+        "title": "Update " + package + " to " + new_version,
+        "needs_pull_request": needs_pull_request,
+    }
+
+
+def push_package(repo, update):
+    """Push a branch from prepare_package(), passing it on if it needs a pull request."""
     # Pushing can succeed or fail depending on whether or not an identically
-    # named branch exists. This is all of the duplicate-checking done; it will
-    # create a pull request exactly once per package version per requirements
-    # file, but it will continue creating pull requests for new versions,
-    # regardless of the status of the previous pull requests. To stop creating
-    # new pull requests, add "skip" to a comment in the requirements file on
-    # the same line as the package.
-    repo.run('push', 'origin', branch_name)
-
-    if new_branch:
-        # Reference: https://developer.github.com/v3/pulls/
-        create_pull_request(repo.path, oauth_token,
-                            "Update " + package + " to " + new_version,
-                            branch_name)
+    # named branch exists. Branches are pushed by name, so this doesn't depend
+    # on what is checked out while the next package is being prepared.
+    repo.run('push', 'origin', update["branch"])
+    return update if update["needs_pull_request"] else None
 
-    # Clean up.
-    repo.run('checkout', 'master')
 
+def open_pull_request(repo, oauth_token, update, base='master'):
+    # Reference: https://developer.github.com/v3/pulls/
+    create_pull_request(repo.path, oauth_token, update["title"], update["branch"], base)
 
-def update_packages(repo, oauth_token, files, package_updates, updater):
-    # Now update each package.
-    for package, (old_version, new_version) in package_updates.items():
-        update_package(repo, files, oauth_token, package, old_version, new_version, updater)
+
+def update_packages(repo, oauth_token, files, package_updates, updater, repo_state=None):
+    """
+    Update each package, using the repo's state from get_repo_states() if
+    known.
+
+    Committing happens in the working tree so is done one package at a time,
+    but pushing and opening pull requests run alongside it, so the next package
+    is prepared while waiting on GitHub. Packages go through in name order. If
+    any of them fail the rest are still done, and then the first error is
+    raised.
+    """
+    base = repo_state["default_branch"] if repo_state else 'master'
+    pull_requests = repo_state["pull_requests"] if repo_state else None
+
+    def prepare(package):
+        # Start from a clean tree, so nothing a failed package left behind
+        # ends up in this one's commit.
+        repo.run('reset', '--hard')
+        repo.run('checkout', '-f', base)
+        old_version, new_version = package_updates[package]
+        return prepare_package(repo, files, package, old_version, new_version, updater, base, pull_requests)
+
+    errors = run_pipeline(sorted(package_updates), [
+        prepare,
+        lambda update: push_package(repo, update),
+        lambda update: open_pull_request(repo, oauth_token, update, base),
+    ])
+
+    # Clean up.
+    repo.run('checkout', base)
+
+    for package, e in errors:
+        print(">> Failed to update %s: %s" % (package, e))
+    if errors:
+        raise errors[0][1]
 
 
 def get_package_updates(repo, files, check_for_updates):
     """
     Returns a dict of package name to (old, new).
+
+    check_for_updates(req_file_path, deadline) has to finish by the repo's
+    deadline.
     """
     print("Updating requirements for %s" % repo.directory)
 
@@ -85,8 +154,76 @@ def get_package_updates(repo, files, check_for_updates):
         print("> Checking requirements in %s" % req_file)
 
         # A dictionary of updates found for this particular file.
-        more_updates = check_for_updates(req_file_path)
+        more_updates = check_for_updates(req_file_path, repo.deadline)
         # Update the global list of packages that need to be updated.
         package_updates.update(more_updates)
 
     return package_updates
+
+
+def main(job, files, check_for_updates, updater):
+    """
+    Check and update the packages in every repo in the inventory or REPOS.
+    """
+    def parse_entry(item):
+        return Entry("repo", item)
+
+    # Check for environment variables
+    entries = load("repo", "REPOS", parse_entry)
+    if entries is None:
+        print("No repos. Add them to the inventory or export REPOS")
+        return 1
+    if "OAUTHTOKEN" not in env:
+        print("No Oauth token. Export OAUTHTOKEN")
+        return 1
+
+    # Get into the right directory or set it up if it doesn't exist.
+    root_path = path.expanduser(path.join('~', 'strongjobs-data'))
+    if not path.exists(root_path):
+        os.makedirs(root_path)
+
+    # Optionally have all the clones share one object database.
+    shared = None
+    if env.get("GITOBJECTSTORE"):
+        shared = SharedObjectStore(path.expanduser(env["GITOBJECTSTORE"]))
+    cache = RepoCache(root_path, parse_size(env.get("REPOCACHEBUDGET", CACHEBUDGET)))
+    used = []
+    repo_states = {}
+
+    def look_up(repo_paths):
+        # Look up existing pull requests and default branches for all the
+        # repos at once rather than asking about each branch.
+        repo_states.update(get_repo_states(repo_paths, env["OAUTHTOKEN"]))
+
+    def update_repo(repo_path, deadline, result):
+        repo_state = repo_states.get(repo_path)
+        cache.use(repo_path)
+        repo = GitRepo(root_path, repo_path, shared, deadline)
+        used.append(repo)
+
+        # Make sure everything is nice and up to date
+        repo.update(repo_state["default_branch"] if repo_state else 'master')
+
+        package_updates = get_package_updates(repo, files, check_for_updates)
+        result["updates"] = len(package_updates)
+        update_packages(repo, env["OAUTHTOKEN"], files, package_updates, updater, repo_state)
+
+    def tidy_up():
+        # Tidy up between runs so fetches stay fast and the disk doesn't fill
+        # up. This only happens while holding the job's lock, so not while
+        # another run of this job may be using the repos.
+        for repo in used:
+            repo.deadline = NO_DEADLINE
+            repo.maintain()
+        # Keep the repos of every tag, not just the ones run this time.
+        cache.evict(list(load("repo", "REPOS", parse_entry, tags=set())))
+        if shared:
+            # Drop evicted and unconfigured repos from the store too, so it
+            # doesn't keep growing.
+            cloned = cache.repos()
+            for repo_path in shared.repos() - set(cloned) - set(cache.in_use()):
+                shared.forget(repo_path)
+            shared.maintain(dict((repo_path, path.join(root_path, repo_path)) for repo_path in cloned))
+
+    return run_targets(job, list(entries), update_repo,
+                       lambda repo_path: entries[repo_path].max_age(MAXAGE), look_up, tidy_up)
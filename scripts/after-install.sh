@@ -1,8 +1,36 @@
 #!/bin/sh
 
+set -eu
+
+# Python environments are built once per set of requirements and kept here.
+readonly ENVROOT=/opt/strongjobs-envs
+# The environment in use, which the crontab puts first on the PATH.
+readonly ENVLINK=/opt/strongjobs-env
+# How many environments to keep around (for quick rollbacks)
+readonly KEEPENVS=3
+
 # Fix up file owners
-chown -R strongjobs:strongjobs /home/strongjobs/
+chown strongjobs:strongjobs /home/strongjobs/
+chown -R strongjobs:strongjobs /home/strongjobs/.ssh
 chown -R strongjobs:strongjobs /opt/strongjobs/
 
-# Install python dependencies
-pip install -r /opt/strongjobs/requirements.txt
+# Install python dependencies into an environment keyed by everything that
+# goes into it, reusing it if it was already built.
+key=$( (cat /opt/strongjobs/requirements.txt /var/lib/strongjobs/system-deps; python --version 2>&1) | sha256sum | cut -c 1-16)
+env=$ENVROOT/$key
+if [ ! -e "$env/.complete" ];
+then
+	rm -rf "$env"
+	mkdir -p $ENVROOT
+	virtualenv --python=python "$env"
+	"$env/bin/pip" install -r /opt/strongjobs/requirements.txt
+	touch "$env/.complete"
+fi
+touch "$env"
+
+# Switch to it atomically, so running jobs never see a half-built environment.
+ln -sfn "$env" $ENVLINK.new
+mv -T $ENVLINK.new $ENVLINK
+
+# Remove the least recently used environments.
+ls -1dt $ENVROOT/*/ | tail -n +$((KEEPENVS + 1)) | xargs -r rm -rf
@@ -1,4 +1,7 @@
 #!/bin/sh
 
-# Start new crontab
-crontab < /opt/strongjobs/crontab
+# Start new crontab, telling the jobs which region they are in so the lease
+# table (LEASEBACKEND) is looked up there.
+# Example: us-west-2c --> us-west-2
+REGION=$(ec2metadata --availability-zone | grep -o '^.*[0-9]\+')
+{ echo "AWS_DEFAULT_REGION=$REGION"; cat /opt/strongjobs/crontab; } | crontab
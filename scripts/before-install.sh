@@ -1,13 +1,31 @@
 #!/bin/sh
 
-# Install dependencies
-apt-get update
-apt-get -y upgrade
-apt-get -y install git curl python python-pip libffi-dev libssl-dev python-dev
+# System packages the jobs need. Changing this list (or the node version)
+# triggers a reinstall on the next deploy.
+readonly PACKAGES="git curl python python-pip python-virtualenv libffi-dev libssl-dev python-dev"
+readonly NODESETUP=https://deb.nodesource.com/setup_6.x
+readonly STAMP=/var/lib/strongjobs/system-deps
 
-# Install a newer version of node than what's available in the ubuntu repos.
-curl -sL https://deb.nodesource.com/setup_6.x | bash -
-apt-get install nodejs
+# Install dependencies, but only when they have changed since the last
+# deploy, so routine deploys are fast and don't depend on what happens to be
+# upstream that day. Security updates are left to unattended-upgrades.
+wanted=$(echo "$PACKAGES $NODESETUP" | sha256sum | cut -d ' ' -f 1)
+if [ "$(cat $STAMP 2>/dev/null)" != "$wanted" ];
+then
+	# Only record them as installed once every step has succeeded, so a
+	# failed install is retried on the next deploy.
+	apt-get update &&
+		apt-get -y install $PACKAGES &&
+		# Install a newer version of node than what's available in the ubuntu
+		# repos.
+		curl -fsSL $NODESETUP -o /tmp/nodesetup &&
+		bash /tmp/nodesetup &&
+		apt-get -y install nodejs &&
+		mkdir -p "$(dirname $STAMP)" &&
+		echo "$wanted" > $STAMP ||
+		{ echo "Installing system dependencies failed"; exit 1; }
+	rm -f /tmp/nodesetup
+fi
 
 # Create user and home dir (/home/strongjobs/)
 useradd -m -G adm strongjobs || true
@@ -18,6 +36,13 @@ useradd -m -G adm strongjobs || true
 readonly REGION=$(ec2metadata --availability-zone | grep -o '^.*[0-9]\+')
 # Sync the environment variables (creds and configurations) down
 aws --region=$REGION s3 cp s3://strongjobs/conf.env /opt/strongjobs/.env
+# And the inventory of targets, if there is one
+if aws --region=$REGION s3api head-object --bucket strongjobs --key inventory > /dev/null 2>&1;
+then
+	aws --region=$REGION s3 cp s3://strongjobs/inventory /opt/strongjobs/inventory
+else
+	rm -f /opt/strongjobs/inventory
+fi
 
 # Set up the ssh key for github
 . /opt/strongjobs/.env  # Needs to be done after aws s3 sync
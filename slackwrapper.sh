@@ -2,6 +2,9 @@
 
 set -euf
 
+# Exit code of jobs that ran out of time (the same as timeout(1) uses)
+readonly TIMEOUTEXIT=124
+
 usage() {
 	cat <<- EOF
 	Usage: $0 {all | fail | succeed} <name> <executable>
@@ -15,6 +18,10 @@ usage() {
 	    Name of job to use in the notification. Needs to be quoted for JSON
 
 	    Executable to run. Exit code is used for determining success or failure
+
+	Environment:
+	    JOBDEADLINE: seconds the job may run for. Jobs that are still running
+	        well after it are killed. Either way they're reported as timed out.
 	EOF
 	exit 1
 }
@@ -30,6 +37,9 @@ notify() {
 	if [ "$errno" = 0 ];
 	then
 		data="{\"attachments\": [{\"fallback\": \"Job \\\"$name\\\" succeeded\", \"color\": \"good\", \"title\": \"Job succeeded\", \"text\": \"$name\"}]}"
+	elif [ "$errno" = "$TIMEOUTEXIT" ];
+	then
+		data="{\"attachments\": [{\"fallback\": \"Job \\\"$name\\\" timed out\", \"color\": \"warning\", \"title\": \"Job timed out\", \"text\": \"$name\"}]}"
 	else
 		data="{\"attachments\": [{\"fallback\": \"Job \\\"$name\\\" failed\", \"color\": \"danger\", \"title\": \"Job failed\", \"text\": \"$name\", \"fields\": [{\"title\": \"Exit code\", \"value\": $errno, \"short\": true}]}]}"
 	fi
@@ -75,7 +85,14 @@ main() {
 	# Run the job
 	set +e
 	# Obviously don't run this with untrusted input
-	output=$($executable 2>&1)
+	if [ -n "${JOBDEADLINE:-}" ];
+	then
+		# Jobs stop themselves at JOBDEADLINE, so this only kills stuck ones,
+		# which then also exit with $TIMEOUTEXIT.
+		output=$(timeout -k 60 $((${JOBDEADLINE%.*} + 300)) $executable 2>&1)
+	else
+		output=$($executable 2>&1)
+	fi
 	# Get exit code
 	errno=$?
 	# Log output to syslog
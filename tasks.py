@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 """Run management tasks locally."""
 
-from time import sleep
+import hashlib
+from os import path
+from threading import Thread
+from time import sleep, time
 
 import boto3
-from botocore.exceptions import NoRegionError
+from botocore.exceptions import ClientError, NoRegionError
 
 from invoke import Collection, run, task
 
@@ -25,158 +28,358 @@ def clientWrapper(service, region=None):
     return cl
 
 
+def splitArg(value, default=None):
+    """Split a comma separated task argument into a list."""
+    if not value:
+        return [default]
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def targetName(target):
+    """Format a (region, stackName) target for output."""
+    region, stackName = target
+    if region:
+        return region + "/" + stackName
+    return stackName
+
+
+def pollUntil(name, getState, isDone, delay=2, maxDelay=30):
+    """Poll getState with exponential backoff until isDone(state) is true.
+
+    Only state transitions are printed, and the delay is reset on each
+    transition. Returns the final state.
+    """
+    initialDelay = delay
+    state = None
+    while True:
+        newState = getState()
+        if newState != state:
+            print("[%s] %s" % (name, newState))
+            state = newState
+            delay = initialDelay
+        if isDone(state):
+            return state
+        sleep(delay)
+        delay = min(delay * 2, maxDelay)
+
+
+def runTargets(targets, work):
+    """Run work(target) for every target concurrently and print a summary.
+
+    work should return a (succeeded, status) tuple. Exits with an error if
+    any target didn't succeed.
+    """
+    results = {}
+
+    def runOne(target):
+        start = time()
+        try:
+            succeeded, status = work(target)
+        except Exception as e:
+            succeeded, status = False, "Error: %s" % e
+        results[target] = (succeeded, status, time() - start)
+
+    threads = [Thread(target=runOne, args=(target,)) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    print("\nSummary:")
+    for target in targets:
+        succeeded, status, duration = results[target]
+        print("  %-40s %-30s %7.1fs" % (targetName(target), status, duration))
+    if not all(results[target][0] for target in targets):
+        raise SystemExit(1)
+
+
 # Default namespace
 @task
 def clean(ctx):
     """Remove created files and caches."""
-    run("rm -rf CloudFormation.json")
+    run("rm -rf CloudFormation.json CloudFormation.json.sha256")
     run("find . \( -name '__pycache__' -o -name '*.pyc' \) -print -delete")
 
 
+DEPLOYDONE = ('Succeeded', 'Failed', 'Stopped',)
+
+
 @task()
-def deploy(ctx, region=None, repo="percipient/strongjobs", commitId=None, wait=True):
-    """Deploy new code at specified revision to instance.
+def deploy(ctx, region=None, stackName="Strongjobs", repo="percipient/strongjobs", commitId=None, wait=True):
+    """Deploy new code at specified revision to instances.
 
     arguments:
+    - region: AWS region name, or a comma separated list of them. Not
+      required if specified in environment
+    - stackName: CloudFormation stack name, or a comma separated list of them
     - repo: GitHub repository path from which to get the code
     - commitId: commit ID to be deployed
-    - wait: wait until the CodeDeploy finishes
+    - wait: wait until the CodeDeploys finish
     """
-    codedeploy = clientWrapper("codedeploy", region)
+    targets = [(r, s) for r in splitArg(region) for s in splitArg(stackName)]
+    # boto3 sessions aren't thread safe, so create the clients up front.
+    clients = dict((r, clientWrapper("codedeploy", r)) for r in splitArg(region))
     if commitId is None:
         commitId = run("git rev-list --max-count=1 HEAD",
                        hide=True).stdout.strip()
         print("Got newest commitId as " + commitId)
 
-    print("Launching CodeDeploy with commit " + commitId)
-    res = codedeploy.create_deployment(applicationName="strongjobs-Strongjobs",
-                                       deploymentGroupName="strongjobs",
-                                       revision={
-                                                "revisionType": "GitHub",
-                                                "gitHubLocation": {
-                                                        "repository": repo,
-                                                        "commitId": commitId,
-                                                        }})
-    depId = res["deploymentId"]
-    print("Deployment ID: " + depId)
-
-    # The deployment is launched at this point, so exit unless asked to wait
-    # until it finishes
-    if not wait:
-        return
-
-    # This should use a boto3 waiter instead, but that hasn't been
-    # implemented yet: https://github.com/boto/boto3/issues/708
-    # So instead we check the status every few seconds manually
-    info = {'status': 'Created'}
-    while info['status'] not in ('Succeeded', 'Failed', 'Stopped',):
-        info = codedeploy.get_deployment(deploymentId=depId)['deploymentInfo']
-        print(info)
-        print(info['status'])
-        sleep(3)
-    if info['status'] == 'Succeeded':
-        print("\nDeploy Succeeded")
-    else:
-        print("\nDeploy Failed")
-        print(info)
+    def deployTarget(target):
+        codedeploy = clients[target[0]]
+        print("[%s] Launching CodeDeploy with commit %s" % (targetName(target), commitId))
+        res = codedeploy.create_deployment(applicationName="strongjobs-" + target[1],
+                                           deploymentGroupName="strongjobs",
+                                           revision={
+                                                    "revisionType": "GitHub",
+                                                    "gitHubLocation": {
+                                                            "repository": repo,
+                                                            "commitId": commitId,
+                                                            }})
+        depId = res["deploymentId"]
+        print("[%s] Deployment ID: %s" % (targetName(target), depId))
+
+        # The deployment is launched at this point, so stop unless asked to
+        # wait until it finishes
+        if not wait:
+            return True, "Created"
+
+        # There is no boto3 waiter for deployments that reports progress
+        # (https://github.com/boto/boto3/issues/708), so poll with backoff.
+        info = {}
+
+        def getStatus():
+            info.update(codedeploy.get_deployment(deploymentId=depId)['deploymentInfo'])
+            return info['status']
+
+        status = pollUntil(targetName(target), getStatus, lambda s: s in DEPLOYDONE)
+        if status != 'Succeeded':
+            print("[%s] Deploy failed: %s" % (targetName(target), info.get('errorInformation', info)))
+        return status == 'Succeeded', status
+
+    runTargets(targets, deployTarget)
 
 
 ns = Collection(clean, deploy)
 
 
 # cf (CloudFormation) namespace
-@task(pre=[clean])
-def makeTemplate(ctx):
-    """Make CloudFormation template."""
+TEMPLATEFILE = "CloudFormation.json"
+TEMPLATEHASHFILE = TEMPLATEFILE + ".sha256"
+# Everything that can change the generated template
+TEMPLATEINPUTS = ["CloudFormation.py", "dev-requirements.txt"]
+
+
+def templateHash():
+    """Hash the inputs of the CloudFormation template."""
+    h = hashlib.sha256()
+    for name in TEMPLATEINPUTS:
+        with open(name, "rb") as f:
+            h.update(name.encode("utf-8") + b"\0" + f.read() + b"\0")
+    return h.hexdigest()
+
+
+@task
+def makeTemplate(ctx, force=False):
+    """Make CloudFormation template if its inputs have changed.
+
+    arguments:
+    - force: rebuild the template even if it is up to date
+    """
+    digest = templateHash()
+    if not force and path.exists(TEMPLATEFILE) and path.exists(TEMPLATEHASHFILE):
+        with open(TEMPLATEHASHFILE, "r") as f:
+            if f.read().strip() == digest:
+                print(TEMPLATEFILE + " is up to date")
+                return
     import CloudFormation  # noqa
+    with open(TEMPLATEHASHFILE, "w") as f:
+        f.write(digest + "\n")
+
+
+def stackParameters(ec2, subnetId, securityGroup, instanceCount):
+    """Build the stack parameters, picking a subnet if one isn't given.
+
+    An instanceCount of None keeps the stack's current one.
+    """
+    if not subnetId:
+        subnetId = ec2.describe_subnets()["Subnets"][0]["SubnetId"]
+        print("Subnet ID not passed, so selecting first one: " + subnetId)
+    if instanceCount is None:
+        instanceCountParameter = {
+            'ParameterKey': 'InstanceCount',
+            'UsePreviousValue': True,
+        }
+    else:
+        instanceCountParameter = {
+            'ParameterKey': 'InstanceCount',
+            'ParameterValue': str(instanceCount),
+        }
+    return [
+        {
+            'ParameterKey': 'SecurityGroup',
+            'ParameterValue': securityGroup,
+        },
+        instanceCountParameter,
+        {
+            'ParameterKey': 'SubnetId',
+            'ParameterValue': subnetId,
+            # I'm not sure why this shouldn't work here, but it gives the
+            # error: "botocore.exceptions.ClientError: An error occurred
+            # (ValidationError) when calling the UpdateStack operation:
+            # Invalid input for parameter key subnetId. Cannot specify
+            # usePreviousValue as true for a parameter key not in the
+            # previous template" FIXME
+            # 'UsePreviousValue': True
+        },
+    ]
+
+
+def stackDone(status):
+    """Whether a stack status is final."""
+    return not status.endswith("_IN_PROGRESS")
+
+
+def waitForStack(cf, target, stackId, successStatus):
+    """Wait for a stack operation to finish, returning (succeeded, status)."""
+    status = pollUntil(targetName(target),
+                       lambda: cf.describe_stacks(StackName=stackId)["Stacks"][0]["StackStatus"],
+                       stackDone)
+    return status == successStatus, status
+
+
+def stackTargets(region, stackName, subnetId, securityGroup, instanceCount):
+    """Build the targets and their clients and parameters.
+
+    Everything is looked up in the main thread since boto3 sessions aren't
+    thread safe.
+    """
+    targets = [(r, s) for r in splitArg(region) for s in splitArg(stackName)]
+    clients = {}
+    for r in splitArg(region):
+        cf = clientWrapper('cloudformation', r)
+        clients[r] = (cf, stackParameters(clientWrapper('ec2', r), subnetId, securityGroup, instanceCount))
+    with open(TEMPLATEFILE, "r") as f:
+        cfTemplate = f.read()
+    return targets, clients, cfTemplate
+
+
+# Final change set statuses. Only CREATE_COMPLETE can be executed.
+CHANGESETDONE = ("CREATE_COMPLETE", "FAILED", "DELETE_COMPLETE", "DELETE_FAILED",)
+# StatusReasons CloudFormation gives for a change set that does nothing
+NOCHANGES = ("didn't contain changes", "No updates are to be performed",)
+
+
+def changeSetChanges(cf, changeSetId):
+    """Yield every change in a change set, following pagination."""
+    kwargs = {"ChangeSetName": changeSetId}
+    while True:
+        res = cf.describe_change_set(**kwargs)
+        for change in res.get("Changes", []):
+            yield change
+        if not res.get("NextToken"):
+            return
+        kwargs["NextToken"] = res["NextToken"]
 
 
 @task(pre=[makeTemplate])
-def create(ctx, region=None, subnetId=None, securityGroup="sg-51530134", wait=True):
-    """Create new CloudFormation stack.
+def create(ctx, region=None, stackName="Strongjobs", subnetId=None, securityGroup="sg-51530134", instanceCount=1, wait=True):
+    """Create new CloudFormation stacks.
 
     arguments:
-    - region: AWS region name. Not required if specified in environment
+    - region: AWS region name, or a comma separated list of them. Not
+      required if specified in environment
+    - stackName: stack name, or a comma separated list of them
     - subnetId: AWS subnet. If not specified, pick one for you
     - securityGroup: AWS SecurityGroup. Default is "default", and will
       fail if you have renamed or deleted it
-    - wait: wait until the CloudFormation stack creation finishes
+    - instanceCount: number of instances to split the jobs between. More
+      than one needs LEASEBACKEND set in conf.env
+    - wait: wait until the CloudFormation stack creations finish
     """
-    ec2 = clientWrapper('ec2', region)
-    if not subnetId:
-        subnetId = ec2.describe_subnets()["Subnets"][0]["SubnetId"]
-        print("Subnet ID not passed, so selecting first one: " + subnetId)
-    with open("CloudFormation.json", "r") as f:
-        cfTemplate = f.read()
-    cf = clientWrapper('cloudformation', region)
-    res = cf.create_stack(
-        StackName='Strongjobs',
-        TemplateBody=cfTemplate,
-        Parameters=[
-            {
-                'ParameterKey': 'SecurityGroup',
-                'ParameterValue': securityGroup,
-            },
-            {
-                'ParameterKey': 'SubnetId',
-                'ParameterValue': subnetId,
-            },
-        ],
-        Capabilities=['CAPABILITY_IAM'],
-    )
-    stackId = res["StackId"]
-    print("CloudFormation stack update started with id: " + stackId)
-    waiter = cf.get_waiter('stack_create_complete')
-    waiter.wait(StackName=stackId)
-    print("CloudFormation create completed")
+    targets, clients, cfTemplate = stackTargets(region, stackName, subnetId, securityGroup, instanceCount)
+
+    def createTarget(target):
+        cf, parameters = clients[target[0]]
+        res = cf.create_stack(
+            StackName=target[1],
+            TemplateBody=cfTemplate,
+            Parameters=parameters,
+            Capabilities=['CAPABILITY_IAM'],
+        )
+        stackId = res["StackId"]
+        print("[%s] CloudFormation stack create started with id: %s" % (targetName(target), stackId))
+        if not wait:
+            return True, "CREATE_IN_PROGRESS"
+        return waitForStack(cf, target, stackId, "CREATE_COMPLETE")
+
+    runTargets(targets, createTarget)
 
 
 @task(default=True, pre=[makeTemplate])
-def update(ctx, region=None, subnetId=None, securityGroup="sg-51530134", wait=True):
-    """Update CloudFormation stack.
+def update(ctx, region=None, stackName="Strongjobs", subnetId=None, securityGroup="sg-51530134", instanceCount=None, wait=True):
+    """Update CloudFormation stacks through change sets.
+
+    Stacks whose change set is empty are left alone.
 
     arguments:
-    - region: AWS region name. Not required if specified in environment
+    - region: AWS region name, or a comma separated list of them. Not
+      required if specified in environment
+    - stackName: stack name, or a comma separated list of them
     - subnetId: AWS subnet. If not specified, this will pick one for you
     - securityGroup: AWS SecurityGroup. Default is "default", and will
       fail if you have renamed or deleted it
-    - wait: wait until the CloudFormation stack creation finishes
+    - instanceCount: number of instances to split the jobs between. More
+      than one needs LEASEBACKEND set in conf.env. Keeps the current number
+      if not given
+    - wait: wait until the CloudFormation stack updates finish
     """
-    ec2 = clientWrapper('ec2', region)
-    if not subnetId:
-        subnetId = ec2.describe_subnets()["Subnets"][0]["SubnetId"]
-        print("Subnet ID not passed, so selecting first one: " + subnetId)
-    with open("CloudFormation.json", "r") as f:
-        cfTemplate = f.read()
-    cf = clientWrapper('cloudformation', region)
-    res = cf.update_stack(
-        StackName='Strongjobs',
-        TemplateBody=cfTemplate,
-        UsePreviousTemplate=False,
-        Capabilities=['CAPABILITY_IAM'],
-        Parameters=[
-            {
-                'ParameterKey': 'SecurityGroup',
-                'ParameterValue': securityGroup,
-            },
-            {
-                'ParameterKey': 'SubnetId',
-                'ParameterValue': subnetId,
-                # I'm not sure why this shouldn't work here, but it gives the
-                # error: "botocore.exceptions.ClientError: An error occurred
-                # (ValidationError) when calling the UpdateStack operation:
-                # Invalid input for parameter key subnetId. Cannot specify
-                # usePreviousValue as true for a parameter key not in the
-                # previous template" FIXME
-                # 'UsePreviousValue': True
-            },
-        ],
-    )
-    stackId = res["StackId"]
-    print("CloudFormation stack update started with id: " + stackId)
-    waiter = cf.get_waiter('stack_create_complete')
-    waiter.wait(StackName=stackId)
-    print("CloudFormation update completed")
+    targets, clients, cfTemplate = stackTargets(region, stackName, subnetId, securityGroup, instanceCount)
+
+    # Name change sets after the template so they're easy to trace back
+    changeSetName = "strongjobs-%s-%d" % (templateHash()[:12], time())
+
+    def updateTarget(target):
+        cf, parameters = clients[target[0]]
+        res = cf.create_change_set(
+            StackName=target[1],
+            ChangeSetName=changeSetName,
+            ChangeSetType="UPDATE",
+            TemplateBody=cfTemplate,
+            UsePreviousTemplate=False,
+            Capabilities=['CAPABILITY_IAM'],
+            Parameters=parameters,
+        )
+        changeSetId = res["Id"]
+        print("[%s] CloudFormation change set created with id: %s" % (targetName(target), changeSetId))
+        changeSet = {}
+
+        def getStatus():
+            changeSet.update(cf.describe_change_set(ChangeSetName=changeSetId))
+            return changeSet["Status"]
+
+        status = pollUntil(targetName(target), getStatus, lambda s: s in CHANGESETDONE)
+        if status == "FAILED":
+            cf.delete_change_set(ChangeSetName=changeSetId)
+            reason = changeSet.get("StatusReason", "")
+            if any(message in reason for message in NOCHANGES):
+                print("[%s] No changes to apply" % targetName(target))
+                return True, "NO_CHANGES"
+            return False, "Change set failed: " + reason
+        if status != "CREATE_COMPLETE":
+            # e.g. deleted by somebody else while we waited on it
+            return False, "Change set " + status
+
+        for change in changeSetChanges(cf, changeSetId):
+            resourceChange = change["ResourceChange"]
+            print("[%s]   %s %s (%s)" % (targetName(target), resourceChange["Action"],
+                                         resourceChange["LogicalResourceId"], resourceChange["ResourceType"]))
+        cf.execute_change_set(ChangeSetName=changeSetId)
+        print("[%s] CloudFormation stack update started" % targetName(target))
+        if not wait:
+            return True, "UPDATE_IN_PROGRESS"
+        return waitForStack(cf, target, changeSet["StackId"], "UPDATE_COMPLETE")
+
+    runTargets(targets, updateTarget)
 
 
 cfCollection = Collection("cf", makeTemplate, create, update)
@@ -186,18 +389,29 @@ ns.add_collection(cfCollection)
 # s3 namespace
 @task()
 def pull(ctx):
-    """Pull s3 env down."""
+    """Pull s3 env and inventory down."""
     s3 = boto3.client('s3')
     s3.download_file("strongjobs", "conf.env", "conf.env")
     print("conf.env downloaded")
+    try:
+        s3.download_file("strongjobs", "inventory", "inventory")
+        print("inventory downloaded")
+    except ClientError as e:
+        # The inventory is optional
+        if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+            raise
+        print("No inventory")
 
 
 @task()
 def push(ctx):
-    """Push s3 env up."""
+    """Push s3 env and inventory up."""
     s3 = boto3.client('s3')
     s3.upload_file("conf.env", "strongjobs", "conf.env")
     print("conf.env uploaded")
+    if path.exists("inventory"):
+        s3.upload_file("inventory", "strongjobs", "inventory")
+        print("inventory uploaded")
 
 
 s3Collection = Collection("s3", push, pull)
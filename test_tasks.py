@@ -0,0 +1,114 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import boto3
+from invoke import Context
+from moto import mock_aws
+
+import tasks
+
+REGIONS = ["us-east-1", "eu-west-1"]
+
+# A stand in for CloudFormation.json with the same parameters
+TEMPLATE = {
+    "Parameters": {
+        "SecurityGroup": {"Type": "String"},
+        "InstanceCount": {"Type": "Number"},
+        "SubnetId": {"Type": "String"},
+    },
+    "Resources": {
+        "Topic": {"Type": "AWS::SNS::Topic"},
+    },
+}
+
+
+class PollUntilTest(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        sleep = tasks.sleep
+        tasks.sleep = self.sleeps.append
+        self.addCleanup(setattr, tasks, "sleep", sleep)
+        self.output = StringIO()
+        self.addCleanup(setattr, sys, "stdout", sys.stdout)
+        sys.stdout = self.output
+
+    def test_prints_only_transitions(self):
+        states = iter(["PENDING", "PENDING", "PENDING", "RUNNING", "DONE"])
+        state = tasks.pollUntil("target", lambda: next(states), lambda s: s == "DONE", delay=1, maxDelay=3)
+        self.assertEqual(state, "DONE")
+        self.assertEqual(self.output.getvalue().splitlines(),
+                         ["[target] PENDING", "[target] RUNNING", "[target] DONE"])
+        # Backing off, and starting over on a transition.
+        self.assertEqual(self.sleeps, [1, 2, 3, 1])
+
+
+class StackTasksTest(unittest.TestCase):
+    def setUp(self):
+        # moto needs credentials, fake ones will do.
+        environ = os.environ.copy()
+        self.addCleanup(os.environ.update, environ)
+        self.addCleanup(os.environ.clear)
+        os.environ.update(AWS_ACCESS_KEY_ID="testing", AWS_SECRET_ACCESS_KEY="testing")
+        mock = mock_aws()
+        mock.start()
+        self.addCleanup(mock.stop)
+
+        # The tasks read the template from the working directory.
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cwd = os.getcwd()
+        os.chdir(directory)
+        self.addCleanup(os.chdir, cwd)
+        with open(tasks.TEMPLATEFILE, "w") as f:
+            json.dump(TEMPLATE, f)
+        for name in tasks.TEMPLATEINPUTS:
+            shutil.copy(os.path.join(os.path.dirname(os.path.abspath(tasks.__file__)), name), name)
+
+        sleep = tasks.sleep
+        tasks.sleep = lambda seconds: None
+        self.addCleanup(setattr, tasks, "sleep", sleep)
+
+    def stack(self, region):
+        cf = boto3.client("cloudformation", region_name=region)
+        return cf.describe_stacks(StackName="Strongjobs")["Stacks"][0]
+
+    def parameters(self, region):
+        return dict((p["ParameterKey"], p["ParameterValue"]) for p in self.stack(region)["Parameters"])
+
+    def test_create(self):
+        tasks.create(Context(), region=",".join(REGIONS), instanceCount=2)
+        for region in REGIONS:
+            self.assertEqual(self.stack(region)["StackStatus"], "CREATE_COMPLETE")
+            self.assertEqual(self.parameters(region)["InstanceCount"], "2")
+
+    def test_update(self):
+        tasks.create(Context(), region=",".join(REGIONS), instanceCount=2)
+        resources = dict(TEMPLATE["Resources"], Queue={"Type": "AWS::SQS::Queue"})
+        with open(tasks.TEMPLATEFILE, "w") as f:
+            json.dump(dict(TEMPLATE, Resources=resources), f)
+
+        tasks.update(Context(), region=",".join(REGIONS))
+        for region in REGIONS:
+            self.assertEqual(self.stack(region)["StackStatus"], "UPDATE_COMPLETE")
+            # The instance count is kept when not given.
+            self.assertEqual(self.parameters(region)["InstanceCount"], "2")
+
+    def test_create_failure_exits(self):
+        tasks.create(Context(), region=REGIONS[0])
+        # The stack already exists in the first region.
+        with self.assertRaises(SystemExit):
+            tasks.create(Context(), region=",".join(REGIONS))
+        self.assertEqual(self.stack(REGIONS[1])["StackStatus"], "CREATE_COMPLETE")
+
+
+if __name__ == "__main__":
+    unittest.main()